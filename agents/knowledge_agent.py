@@ -1,81 +1,253 @@
 """Knowledge Agent - handles RAG-based queries using Infinitepay documentation."""
+import os
+import json
+import math
 import time
+import asyncio
+import hashlib
+import shutil
+import tempfile
+import threading
+import traceback
+from contextlib import contextmanager
 import requests
-from bs4 import BeautifulSoup
-from typing import List, Dict, Any
+import faiss
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import List, Dict, Any, Iterator, Optional, Tuple, Union
 from openai import OpenAI
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain.text_splitter import TokenTextSplitter
 from langchain_openai import OpenAIEmbeddings
 from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain.chains import RetrievalQA
-from langchain_openai import ChatOpenAI
+from langchain_core.prompts import ChatPromptTemplate
 from models import AgentType, KnowledgeResponse, ChatMessage
 from utils.logger import StructuredLogger
-from utils.security import SecurityValidator
+from utils.security import get_security_validator
+from utils.http_client import shared_http_client
+from utils.embeddings import get_embeddings
+from utils.llm import get_chat_llm
+from utils.semantic_cache import SemanticCache, get_cache_redis
+from utils.retrievers import ThresholdMMRRetriever
 from config import Config
 
+# Pages are parsed with lxml XPath; BeautifulSoup's pure-Python parser is the fallback,
+# imported only when lxml is missing
+try:
+    from lxml import etree, html as lxml_html
+except ImportError:
+    lxml_html = None
+
+# Tags whose text is extracted from the main documentation page
+_CONTENT_TAGS = ['h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'p', 'div']
+
+if lxml_html is not None:
+    _MAIN_CONTENT_XPATHS = [
+        etree.XPath("//main"),
+        etree.XPath("//div[contains(concat(' ', normalize-space(@class), ' '), ' content ')]"),
+        etree.XPath("//body")
+    ]
+    _CONTENT_XPATH = etree.XPath(".//*[" + " or ".join(f"self::{tag}" for tag in _CONTENT_TAGS) + "]")
+    _LINK_XPATH = etree.XPath("//a/@href")
+    # Text nodes joined the way BeautifulSoup's get_text(strip=True) does
+    _TEXT_XPATH = etree.XPath(".//text()[not(ancestor::script or ancestor::style)]")
+
+# Limits for following navigation links from the main documentation page
+_MAX_LINKED_PAGES = 10
+_MAX_SCANNED_LINKS = 50
+_BASE_URL_PREFIX = Config.KNOWLEDGE_BASE_URL.rstrip('/') + '/'
+
+def _normalize_doc_url(href: str) -> Optional[str]:
+    """Expand a relative link and return it only if it points to Infinitepay docs."""
+    if not href:
+        return None
+    if not href.startswith('http'):
+        href = _BASE_URL_PREFIX + href.lstrip('/')
+    return href if 'infinitepay.io' in href else None
+
+def _node_text(node) -> str:
+    """Concatenate the stripped text nodes under an lxml element."""
+    return "".join(text.strip() for text in _TEXT_XPATH(node))
+
+def _parse_main_page(content: bytes) -> Tuple[List[Tuple[str, str]], List[str]]:
+    """Return (tag, text) pairs of the main content elements and the page's link targets."""
+    if lxml_html is None:
+        from bs4 import BeautifulSoup
+        soup = BeautifulSoup(content, "html.parser")
+        main_content = soup.find('main') or soup.find('div', class_='content') or soup.find('body')
+        elements = main_content.find_all(_CONTENT_TAGS) if main_content else []
+        links = soup.find_all('a', href=True, limit=_MAX_SCANNED_LINKS)
+        return (
+            [(element.name, element.get_text(strip=True)) for element in elements],
+            [link['href'] for link in links]
+        )
+    
+    tree = lxml_html.document_fromstring(content)
+    main_content = next((nodes[0] for nodes in (xpath(tree) for xpath in _MAIN_CONTENT_XPATHS) if nodes), None)
+    elements = _CONTENT_XPATH(main_content) if main_content is not None else []
+    return (
+        [(element.tag, _node_text(element)) for element in elements],
+        [str(href) for href in _LINK_XPATH(tree)[:_MAX_SCANNED_LINKS]]
+    )
+
+def _parse_page_text(content: bytes) -> str:
+    """Return the full text of a linked documentation page."""
+    if lxml_html is None:
+        from bs4 import BeautifulSoup
+        return BeautifulSoup(content, "html.parser").get_text(strip=True)
+    return _node_text(lxml_html.document_fromstring(content))
+
+def _resolve_index_factory(num_vectors: int, dim: int) -> str:
+    """Pick the FAISS index layout for a corpus of the given size."""
+    if Config.FAISS_INDEX_FACTORY != "auto":
+        return Config.FAISS_INDEX_FACTORY
+    
+    # Small corpora: graph search over scalar-quantized vectors
+    pq_subquantizers = next((m for m in (64, 32, 16, 8) if dim % m == 0), None)
+    if num_vectors < Config.FAISS_IVF_MIN_VECTORS or pq_subquantizers is None:
+        return f"HNSW32,{Config.FAISS_HNSW_ENCODING}"
+    
+    # Large corpora: inverted lists over product-quantized codes
+    nlist = max(4, int(math.sqrt(num_vectors)))
+    return f"IVF{nlist},PQ{pq_subquantizers}"
+
+def _tune_index(index: faiss.Index):
+    """Apply search-time parameters to a built or loaded index."""
+    if hasattr(index, "hnsw"):
+        index.hnsw.efSearch = Config.FAISS_HNSW_EF_SEARCH
+    
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = Config.FAISS_IVF_NPROBE
+        # MMR reconstructs candidate vectors by id
+        ivf.make_direct_map()
+
+# Bump when scraping or chunking changes what ends up in the index
+_SCRAPER_VERSION = 1
+
+# Files making up a persisted vector store; the manifest is swapped in last
+_INDEX_FILES = ("index.faiss", "index.pkl", "manifest.json")
+
+# Cross-process lock so only one uvicorn worker builds the index at a time (POSIX only)
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+@contextmanager
+def _index_lock():
+    """Hold an exclusive lock on the persisted index directory."""
+    os.makedirs(Config.FAISS_DIR, exist_ok=True)
+    with open(os.path.join(Config.FAISS_DIR, ".lock"), "w") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+# Shared HTTP session so documentation pages reuse pooled keep-alive connections
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    # Enough connections for every scraper worker to keep one alive
+    pool_maxsize=max(16, Config.SCRAPER_MAX_WORKERS),
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+))
+_SESSION.headers.update({
+    "User-Agent": "ModularChatbot/1.0 (+knowledge-agent)",
+    "Accept-Encoding": "gzip, deflate"
+})
+
+# RAG components shared by every KnowledgeAgent in the process, built once on first use
+_rag_lock = threading.Lock()
+_rag_components: Dict[str, Any] = {}
+
 class KnowledgeAgent:
     """Knowledge agent that uses RAG to answer questions about Infinitepay."""
     
+    # Built once and shared by every QA chain
+    QA_PROMPT = ChatPromptTemplate.from_messages([
+        (
+            "system",
+            "Use the following pieces of context to answer the user's question.\n"
+            "If you don't know the answer, just say that you don't know, don't try to make up an answer.\n"
+            "----------------\n"
+            "{context}"
+        ),
+        ("human", "{question}")
+    ])
+    
     def __init__(self):
-        self.client = OpenAI(api_key=Config.OPENAI_API_KEY)
+        self.client = OpenAI(api_key=Config.OPENAI_API_KEY, http_client=shared_http_client)
         self.logger = StructuredLogger("KnowledgeAgent")
-        self.security_validator = SecurityValidator()
-        self.vectorstore = None
-        self.qa_chain = None
+        self.security_validator = get_security_validator()
         self._initialize_rag_system()
     
+    @property
+    def vectorstore(self) -> Optional[FAISS]:
+        """Shared FAISS vector store, or None if the RAG system is unavailable."""
+        return _rag_components.get("vectorstore")
+    
+    @property
+    def qa_chain(self) -> Optional[RetrievalQA]:
+        """Shared retrieval QA chain, or None if the RAG system is unavailable."""
+        return _rag_components.get("qa_chain")
+    
+    @property
+    def answer_cache(self) -> Optional[SemanticCache]:
+        """Shared semantic cache of answers produced by the current index."""
+        return _rag_components.get("answer_cache")
+    
+    def _set_rag_components(self, vectorstore: FAISS, content_hash: str):
+        """Publish a vector store and the components built on it to every agent."""
+        _rag_components.update(
+            vectorstore=vectorstore,
+            qa_chain=self._create_qa_chain(vectorstore),
+            # Answers cached against a previous index may be stale, so each index content
+            # gets its own namespace; workers still serving the old index keep theirs
+            answer_cache=SemanticCache(
+                self._create_embeddings(),
+                redis_client=get_cache_redis(),
+                namespace=f"knowledge:{content_hash}",
+                encode=lambda response: response.model_dump_json(),
+                decode=KnowledgeResponse.model_validate_json
+            )
+        )
+    
     def _scrape_infinitepay_docs(self) -> List[Dict[str, str]]:
         """Scrape Infinitepay documentation and return structured content."""
         try:
             self.logger.log_info("Starting documentation scraping...")
             
             # Main documentation page
-            response = requests.get(Config.KNOWLEDGE_BASE_URL, timeout=30)
+            response = _SESSION.get(Config.KNOWLEDGE_BASE_URL, timeout=30)
             response.raise_for_status()
             
-            soup = BeautifulSoup(response.content, 'html.parser')
-            
-            # Extract text content from the page
-            content = []
+            elements, hrefs = _parse_main_page(response.content)
             
-            # Get main content areas
-            main_content = soup.find('main') or soup.find('div', class_='content') or soup.find('body')
+            # Extract headings and their content from the main content area
+            content = [
+                {'text': text, 'tag': tag, 'source': Config.KNOWLEDGE_BASE_URL}
+                for tag, text in elements
+                if len(text) > 10  # Filter out very short text
+            ]
             
-            if main_content:
-                # Extract headings and their content
-                for element in main_content.find_all(['h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'p', 'div']):
-                    text = element.get_text(strip=True)
-                    if text and len(text) > 10:  # Filter out very short text
-                        content.append({
-                            'text': text,
-                            'tag': element.name,
-                            'source': Config.KNOWLEDGE_BASE_URL
-                        })
+            # Also try to find navigation links to other documentation pages,
+            # stopping as soon as enough candidates are collected
+            page_urls = []
             
-            # Also try to find navigation links to other documentation pages
-            nav_links = soup.find_all('a', href=True)
-            additional_pages = []
+            for href in hrefs:
+                url = _normalize_doc_url(href)
+                if url and url not in page_urls:
+                    page_urls.append(url)
+                    if len(page_urls) == _MAX_LINKED_PAGES:  # Avoid too many requests
+                        break
             
-            for link in nav_links[:10]:  # Limit to first 10 links to avoid too many requests
-                href = link.get('href')
-                if href and not href.startswith('http'):
-                    href = Config.KNOWLEDGE_BASE_URL.rstrip('/') + '/' + href.lstrip('/')
-                
-                if href and 'infinitepay.io' in href:
-                    try:
-                        page_response = requests.get(href, timeout=10)
-                        if page_response.status_code == 200:
-                            page_soup = BeautifulSoup(page_response.content, 'html.parser')
-                            page_content = page_soup.get_text(strip=True)
-                            if page_content and len(page_content) > 100:
-                                content.append({
-                                    'text': page_content[:2000],  # Limit content length
-                                    'tag': 'page',
-                                    'source': href
-                                })
-                    except:
-                        continue  # Skip pages that fail to load
+            # Fetch the linked pages concurrently; map() keeps results in link order
+            if page_urls:
+                with ThreadPoolExecutor(max_workers=Config.SCRAPER_MAX_WORKERS) as executor:
+                    content.extend(page for page in executor.map(self._fetch_page, page_urls) if page)
             
             # If no content was scraped, add comprehensive fallback content
             if not content:
@@ -89,6 +261,22 @@ class KnowledgeAgent:
             # Return comprehensive fallback content
             return self._get_fallback_content()
     
+    def _fetch_page(self, url: str) -> Optional[Dict[str, str]]:
+        """Fetch a linked documentation page and return its text content."""
+        try:
+            page_response = _SESSION.get(url, timeout=10)
+            if page_response.status_code == 200:
+                page_content = _parse_page_text(page_response.content)
+                if page_content and len(page_content) > 100:
+                    return {
+                        'text': page_content[:2000],  # Limit content length
+                        'tag': 'page',
+                        'source': url
+                    }
+        except Exception:
+            pass  # Skip pages that fail to load
+        return None
+    
     def _get_fallback_content(self) -> List[Dict[str, str]]:
         """Get comprehensive fallback content about Infinitepay."""
         return [
@@ -124,6 +312,52 @@ class KnowledgeAgent:
             }
         ]
     
+    def _create_embeddings(self) -> OpenAIEmbeddings:
+        """Return the shared embeddings client; query embeddings are served from an LRU cache."""
+        return get_embeddings()
+    
+    def _embed_batches(self, embeddings: OpenAIEmbeddings, texts: List[str]) -> Iterator[np.ndarray]:
+        """Embed texts in large batches, yielding each batch's vectors in order as it completes."""
+        batch_size = Config.EMBEDDING_BATCH_SIZE
+        batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+        
+        # Later requests stay in flight while the caller indexes the batches already returned
+        with ThreadPoolExecutor(max_workers=Config.EMBEDDING_MAX_WORKERS) as executor:
+            for batch_vectors in executor.map(embeddings.embed_documents, batches):
+                yield np.asarray(batch_vectors, dtype=np.float32)
+        
+        self.logger.log_info(
+            f"Embedded {len(texts)} chunks in {len(batches)} requests",
+            metadata={"batch_size": batch_size}
+        )
+    
+    def _build_index(self, embeddings: OpenAIEmbeddings, texts: List[str]) -> Tuple[faiss.Index, str]:
+        """Embed the chunks and build the FAISS index, adding each batch as soon as it is embedded."""
+        index, index_factory, untrained_batches = None, None, []
+        
+        for vectors in self._embed_batches(embeddings, texts):
+            if index is None:
+                # Build an approximate index instead of the default exhaustive flat index
+                index_factory = _resolve_index_factory(len(texts), vectors.shape[1])
+                index = faiss.index_factory(vectors.shape[1], index_factory)
+            
+            # Indexes that need training (IVF-PQ) wait for the full set of vectors
+            if index.is_trained:
+                index.add(vectors)
+            else:
+                untrained_batches.append(vectors)
+        
+        if index is None:
+            raise ValueError("No chunks to index")
+        
+        if untrained_batches:
+            vectors = np.concatenate(untrained_batches)
+            index.train(vectors)
+            index.add(vectors)
+        
+        _tune_index(index)
+        return index, index_factory
+    
     def _create_vectorstore(self, documents: List[Dict[str, str]]) -> FAISS:
         """Create FAISS vector store from documents."""
         try:
@@ -131,177 +365,431 @@ class KnowledgeAgent:
             texts = [doc['text'] for doc in documents]
             sources = [doc['source'] for doc in documents]
             
-            # Split documents into chunks
-            text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=1000,
-                chunk_overlap=200,
-                length_function=len
+            # Split documents into token windows with the embedding model's tokenizer
+            text_splitter = TokenTextSplitter(
+                encoding_name="cl100k_base",
+                chunk_size=Config.CHUNK_SIZE,
+                chunk_overlap=Config.CHUNK_OVERLAP
             )
             
             chunks = text_splitter.create_documents(texts, metadatas=[{'source': source} for source in sources])
             
-            # Create embeddings
-            embeddings = OpenAIEmbeddings(api_key=Config.OPENAI_API_KEY)
+            # Create embeddings and the index
+            embeddings = self._create_embeddings()
+            index, index_factory = self._build_index(embeddings, [chunk.page_content for chunk in chunks])
             
             # Create vector store
-            vectorstore = FAISS.from_documents(chunks, embeddings)
+            index_to_docstore_id = {i: str(i) for i in range(len(chunks))}
+            vectorstore = FAISS(
+                embedding_function=embeddings,
+                index=index,
+                docstore=InMemoryDocstore({str(i): chunk for i, chunk in enumerate(chunks)}),
+                index_to_docstore_id=index_to_docstore_id
+            )
             
-            self.logger.log_info(f"Created vector store with {len(chunks)} chunks")
+            self.logger.log_info(
+                f"Created vector store with {len(chunks)} chunks",
+                metadata={"index_factory": index_factory}
+            )
             return vectorstore
             
         except Exception as e:
             self.logger.log_error(AgentType.KNOWLEDGE, f"Vector store creation failed: {str(e)}")
             raise
     
-    def _initialize_rag_system(self):
-        """Initialize the RAG system with documentation."""
+    def _is_fallback(self, documents: List[Dict[str, str]]) -> bool:
+        """Whether the documents are the built-in fallback content rather than scraped pages."""
+        return all(doc['tag'] == 'fallback' for doc in documents)
+    
+    def _hash_documents(self, documents: List[Dict[str, str]]) -> str:
+        """Compute a content hash of the scraped documents."""
+        digest = hashlib.sha256()
+        for doc in documents:
+            digest.update(doc['source'].encode('utf-8'))
+            digest.update(doc['text'].encode('utf-8'))
+        return digest.hexdigest()
+    
+    def _index_settings(self) -> Dict[str, Any]:
+        """Settings that determine the index contents; a change requires a rebuild."""
+        return {
+            "embedding_model": Config.EMBEDDING_MODEL,
+            "source_url": Config.KNOWLEDGE_BASE_URL,
+            "scraper_version": _SCRAPER_VERSION,
+            "index_factory": Config.FAISS_INDEX_FACTORY,
+            "hnsw_encoding": Config.FAISS_HNSW_ENCODING,
+            "chunk_size": Config.CHUNK_SIZE,
+            "chunk_overlap": Config.CHUNK_OVERLAP
+        }
+    
+    def _read_manifest(self, directory: Optional[str] = None) -> Dict[str, Any]:
+        """Read the manifest stored alongside the persisted index."""
+        manifest_path = os.path.join(directory or Config.FAISS_DIR, "manifest.json")
         try:
-            self.logger.log_info("Initializing RAG system...")
-            
-            # Check if OpenAI API key is available
-            if not Config.OPENAI_API_KEY:
-                self.logger.log_error(AgentType.KNOWLEDGE, "OpenAI API key not configured")
-                self.vectorstore = None
-                self.qa_chain = None
+            with open(manifest_path, "r", encoding="utf-8") as manifest_file:
+                return json.load(manifest_file)
+        except (OSError, ValueError):
+            return {}
+    
+    def _load_vectorstore(self, directory: Optional[str] = None,
+                          content_hash: Optional[str] = None) -> Optional[FAISS]:
+        """Load a persisted FAISS vector store from disk, if available.
+        
+        With ``content_hash``, the index is only loaded if it was built from that content.
+        """
+        directory = directory or Config.FAISS_DIR
+        if not os.path.exists(os.path.join(directory, "index.faiss")):
+            return None
+        
+        # An index built from another model, source, layout or chunking must be rebuilt
+        manifest = self._read_manifest(directory)
+        expected = {**self._index_settings(), **({"content_hash": content_hash} if content_hash else {})}
+        if any(manifest.get(key) != value for key, value in expected.items()):
+            self.logger.log_info(f"Persisted vector store in {directory} uses different index settings, rebuilding")
+            return None
+        
+        try:
+            embeddings = self._create_embeddings()
+            # Memory-map the index so workers loading the same file share its pages
+            vectorstore = FAISS.load_local(
+                directory,
+                embeddings,
+                allow_dangerous_deserialization=True,
+                io_flags=faiss.IO_FLAG_MMAP
+            )
+            _tune_index(vectorstore.index)
+            self.logger.log_info(f"Loaded persisted vector store from {directory}")
+            return vectorstore
+        except Exception as e:
+            self.logger.log_error(AgentType.KNOWLEDGE, f"Failed to load persisted vector store: {str(e)}")
+            return None
+    
+    def _save_vectorstore(self, vectorstore: FAISS, content_hash: str, directory: Optional[str] = None):
+        """Persist the FAISS vector store and its content manifest to disk.
+        
+        Files are written to a staging directory and renamed into place, so readers
+        (including workers memory-mapping the old index) never see a partial write.
+        """
+        directory = directory or Config.FAISS_DIR
+        try:
+            os.makedirs(directory, exist_ok=True)
+            staging_dir = tempfile.mkdtemp(prefix=".staging-", dir=directory)
+            try:
+                vectorstore.save_local(staging_dir)
+                with open(os.path.join(staging_dir, "manifest.json"), "w", encoding="utf-8") as manifest_file:
+                    json.dump({
+                        "content_hash": content_hash,
+                        **self._index_settings(),
+                        "created_at": time.time()
+                    }, manifest_file)
+                
+                # Without a manifest the index is never loaded, so a crash mid-swap forces a rebuild
+                manifest_path = os.path.join(directory, "manifest.json")
+                if os.path.exists(manifest_path):
+                    os.remove(manifest_path)
+                for name in _INDEX_FILES:
+                    os.replace(os.path.join(staging_dir, name), os.path.join(directory, name))
+            finally:
+                shutil.rmtree(staging_dir, ignore_errors=True)
+            
+            self.logger.log_info(f"Persisted vector store to {directory}")
+        except Exception as e:
+            self.logger.log_error(AgentType.KNOWLEDGE, f"Failed to persist vector store: {str(e)}")
+    
+    def _build_vectorstore(self) -> Tuple[Optional[FAISS], Optional[str]]:
+        """Scrape documentation, embed it and persist the resulting vector store.
+        
+        Returns the vector store and the content hash of the documents it was built from.
+        """
+        self.logger.log_info("Scraping Infinitepay documentation...")
+        documents = self._scrape_infinitepay_docs()
+        
+        if not documents:
+            self.logger.log_error(AgentType.KNOWLEDGE, "No documents scraped from Infinitepay")
+            return None, None
+        
+        content_hash = self._hash_documents(documents)
+        
+        # The fallback content is embedded once and kept apart from the scraped index,
+        # so later failed scrapes load it without any OpenAI calls and successful ones replace it
+        if self._is_fallback(documents):
+            vectorstore = self._load_vectorstore(Config.FAISS_FALLBACK_DIR, content_hash)
+            if vectorstore is None:
+                vectorstore = self._create_vectorstore(documents)
+                self._save_vectorstore(vectorstore, content_hash, Config.FAISS_FALLBACK_DIR)
+            return vectorstore, content_hash
+        
+        self.logger.log_info("Creating vector store...")
+        vectorstore = self._create_vectorstore(documents)
+        self._save_vectorstore(vectorstore, content_hash)
+        return vectorstore, content_hash
+    
+    def _create_qa_chain(self, vectorstore: FAISS) -> RetrievalQA:
+        """Create the retrieval QA chain on top of a vector store."""
+        llm = get_chat_llm(Config.KNOWLEDGE_MODEL)
+        
+        # Fewer, more diverse and relevant chunks keep the stuffed prompt small
+        retriever = ThresholdMMRRetriever(
+            vectorstore=vectorstore,
+            k=Config.RETRIEVAL_K,
+            fetch_k=Config.RETRIEVAL_FETCH_K,
+            lambda_mult=Config.RETRIEVAL_LAMBDA_MULT,
+            similarity_threshold=Config.RETRIEVAL_SIMILARITY_THRESHOLD,
+            distance_gap_ratio=Config.RETRIEVAL_DISTANCE_GAP_RATIO
+        )
+        
+        return RetrievalQA.from_chain_type(
+            llm=llm,
+            chain_type="stuff",
+            retriever=retriever,
+            return_source_documents=True,
+            chain_type_kwargs={"prompt": self.QA_PROMPT}
+        )
+    
+    def _initialize_rag_system(self):
+        """Initialize the shared RAG system once, reusing the persisted index when present."""
+        if _rag_components:
+            return
+        
+        with _rag_lock:
+            if _rag_components:
                 return
             
-            # Scrape documentation
-            self.logger.log_info("Scraping Infinitepay documentation...")
+            try:
+                self.logger.log_info("Initializing RAG system...")
+                
+                # Check if OpenAI API key is available
+                if not Config.OPENAI_API_KEY:
+                    self.logger.log_error(AgentType.KNOWLEDGE, "OpenAI API key not configured")
+                    return
+                
+                # Only scrape and re-embed when no persisted index is available;
+                # other workers wait here and then load what the first one built
+                with _index_lock():
+                    vectorstore = self._load_vectorstore()
+                    if vectorstore:
+                        content_hash = self._read_manifest().get("content_hash")
+                    else:
+                        vectorstore, content_hash = self._build_vectorstore()
+                
+                if not vectorstore:
+                    return
+                
+                # Create QA chain
+                self.logger.log_info("Creating QA chain...")
+                self._set_rag_components(vectorstore, content_hash)
+                
+                self.logger.log_info("RAG system initialized successfully")
+                
+            except Exception as e:
+                self.logger.log_error(AgentType.KNOWLEDGE, f"RAG system initialization failed: {str(e)}")
+                self.logger.log_error(AgentType.KNOWLEDGE, f"Traceback: {traceback.format_exc()}")
+                # Leave the components unset so the next agent retries
+                _rag_components.clear()
+    
+    def refresh(self) -> bool:
+        """Re-scrape the documentation and rebuild the index if its content changed.
+        
+        Intended to be run in the background; returns True when the index was rebuilt.
+        The rebuilt index is shared by every KnowledgeAgent in the process.
+        """
+        try:
             documents = self._scrape_infinitepay_docs()
+            # A failed scrape keeps serving the current index
+            if not documents or self._is_fallback(documents):
+                return False
             
-            if not documents:
-                self.logger.log_error(AgentType.KNOWLEDGE, "No documents scraped from Infinitepay")
-                self.vectorstore = None
-                self.qa_chain = None
-                return
+            content_hash = self._hash_documents(documents)
+            if self.vectorstore and content_hash == self._read_manifest().get("content_hash"):
+                self.logger.log_info("Documentation unchanged, keeping persisted vector store")
+                return False
             
-            # Create vector store
-            self.logger.log_info("Creating vector store...")
-            self.vectorstore = self._create_vectorstore(documents)
-            
-            # Create QA chain
-            self.logger.log_info("Creating QA chain...")
-            llm = ChatOpenAI(
-                api_key=Config.OPENAI_API_KEY,
-                model_name=Config.KNOWLEDGE_MODEL,
-                temperature=0.1
-            )
+            vectorstore = self._create_vectorstore(documents)
+            with _index_lock():
+                self._save_vectorstore(vectorstore, content_hash)
             
-            retriever = self.vectorstore.as_retriever(search_kwargs={"k": 3})
-            
-            self.qa_chain = RetrievalQA.from_chain_type(
-                llm=llm,
-                chain_type="stuff",
-                retriever=retriever,
-                return_source_documents=True
-            )
-            
-            self.logger.log_info("RAG system initialized successfully")
+            with _rag_lock:
+                self._set_rag_components(vectorstore, content_hash)
+            self.logger.log_info("Vector store refreshed", metadata={"content_hash": content_hash})
+            return True
             
         except Exception as e:
-            self.logger.log_error(AgentType.KNOWLEDGE, f"RAG system initialization failed: {str(e)}")
-            import traceback
-            self.logger.log_error(AgentType.KNOWLEDGE, f"Traceback: {traceback.format_exc()}")
-            # Initialize with empty vector store as fallback
-            self.vectorstore = None
-            self.qa_chain = None
+            self.logger.log_error(AgentType.KNOWLEDGE, f"Vector store refresh failed: {str(e)}")
+            return False
     
     def _extract_sources(self, source_documents) -> List[str]:
-        """Extract unique sources from retrieved documents."""
-        sources = set()
-        for doc in source_documents:
-            if hasattr(doc, 'metadata') and 'source' in doc.metadata:
-                sources.add(doc.metadata['source'])
-        return list(sources)
+        """Extract unique sources from retrieved documents, in retrieval order."""
+        return list(dict.fromkeys(
+            doc.metadata['source'] for doc in source_documents
+            if getattr(doc, 'metadata', None) and 'source' in doc.metadata
+        ))
+    
+    def _prepare_query(self, chat_message: ChatMessage, start_time: float) -> Union[KnowledgeResponse, str]:
+        """Validate the question and return either a final response or the sanitized query."""
+        # Sanitize input message and check it for prompt injection
+        sanitized_message, injection_check = self.security_validator.scan_and_sanitize(chat_message.message)
+        if injection_check["is_suspicious"]:
+            self.logger.log_info(
+                "Prompt injection detected in knowledge query",
+                metadata={
+                    "confidence": injection_check["confidence"],
+                    "patterns": injection_check["patterns_found"]
+                }
+            )
+            
+            return KnowledgeResponse(
+                answer="Desculpe, mas sua pergunta contém instruções não permitidas. Por favor, faça uma pergunta sobre Infinitepay ou matemática.",
+                sources=[Config.KNOWLEDGE_BASE_URL],
+                execution_time=time.time() - start_time,
+                timestamp=chat_message.timestamp,
+                user_message=chat_message.message
+            )
+        
+        if not self.qa_chain:
+            # Fallback response if RAG system is not available
+            return KnowledgeResponse(
+                answer="Desculpe, mas a base de conhecimento está temporariamente indisponível. Tente novamente mais tarde ou visite a documentação do Infinitepay diretamente.",
+                sources=[Config.KNOWLEDGE_BASE_URL],
+                execution_time=time.time() - start_time,
+                timestamp=chat_message.timestamp,
+                user_message=chat_message.message
+            )
+        
+        return sanitized_message
+    
+    def _lookup_cached_answer(self, chat_message: ChatMessage, sanitized_message: str,
+                              start_time: float) -> Tuple[Optional[KnowledgeResponse], Optional[np.ndarray]]:
+        """Serve near-duplicate questions from the semantic cache.
+        
+        Returns the cached response (if any) and the query vector used for the lookup.
+        """
+        if not self.answer_cache:
+            return None, None
+        
+        query_vector = self.answer_cache.embed(sanitized_message)
+        cached_response = self.answer_cache.get(query_vector)
+        if not cached_response:
+            return None, query_vector
+        
+        self.logger.log_info(
+            "Knowledge answer served from semantic cache",
+            agent_type=AgentType.KNOWLEDGE,
+            conversation_id=chat_message.conversation_id,
+            user_id=chat_message.user_id
+        )
+        return cached_response.model_copy(update={
+            "execution_time": time.time() - start_time,
+            "timestamp": chat_message.timestamp,
+            "user_message": chat_message.message
+        }), query_vector
+    
+    def _build_response(self, chat_message: ChatMessage, result: Dict[str, Any],
+                        start_time: float) -> KnowledgeResponse:
+        """Build and log the response for a QA chain result."""
+        # Extract answer and sources
+        answer = result["result"]
+        sources = self._extract_sources(result.get("source_documents", []))
+        
+        # If no sources found, add the main documentation URL
+        if not sources:
+            sources = [Config.KNOWLEDGE_BASE_URL]
+        
+        execution_time = time.time() - start_time
+        
+        # Log execution with full observability
+        self.logger.log_agent_execution(
+            agent_type=AgentType.KNOWLEDGE,
+            message=chat_message.message,
+            execution_time=execution_time,
+            conversation_id=chat_message.conversation_id,
+            user_id=chat_message.user_id,
+            processed_content=answer,
+            metadata={
+                "sources_count": len(sources),
+                "sources": sources,
+                "rag_system_available": True
+            }
+        )
+        
+        response = KnowledgeResponse(
+            answer=answer,
+            sources=sources,
+            execution_time=execution_time,
+            timestamp=chat_message.timestamp,
+            user_message=chat_message.message
+        )
+        
+        return response
+    
+    def _cache_answer(self, query_vector: Optional[np.ndarray], response: KnowledgeResponse):
+        """Store a fresh answer in the semantic cache, which also publishes it through Redis."""
+        if query_vector is not None:
+            self.answer_cache.put(query_vector, response)
+    
+    def _error_response(self, chat_message: ChatMessage, error: Exception, start_time: float) -> KnowledgeResponse:
+        """Log a query failure and return a safe response."""
+        execution_time = time.time() - start_time
+        self.logger.log_error(
+            AgentType.KNOWLEDGE, 
+            f"Knowledge query failed: {str(error)}",
+            conversation_id=chat_message.conversation_id,
+            user_id=chat_message.user_id,
+            execution_time=execution_time,
+            metadata={"error_type": "knowledge_query_failure"}
+        )
+        
+        return KnowledgeResponse(
+            answer="Desculpe, ocorreu um erro ao processar sua pergunta. Tente reformular sua pergunta ou visite a documentação do Infinitepay para mais informações.",
+            sources=[Config.KNOWLEDGE_BASE_URL],
+            execution_time=execution_time,
+            timestamp=chat_message.timestamp,
+            user_message=chat_message.message
+        )
     
     def answer_question(self, chat_message: ChatMessage) -> KnowledgeResponse:
         """Answer user question using RAG system."""
         start_time = time.time()
         
         try:
-            # Sanitize input message
-            sanitized_message = self.security_validator.sanitize_input(chat_message.message)
+            prepared = self._prepare_query(chat_message, start_time)
+            if isinstance(prepared, KnowledgeResponse):
+                return prepared
             
-            # Check for prompt injection
-            injection_check = self.security_validator.detect_prompt_injection(sanitized_message)
-            if injection_check["is_suspicious"]:
-                self.logger.log_info(
-                    "Prompt injection detected in knowledge query",
-                    metadata={
-                        "confidence": injection_check["confidence"],
-                        "patterns": injection_check["patterns_found"]
-                    }
-                )
-                
-                return KnowledgeResponse(
-                    answer="Desculpe, mas sua pergunta contém instruções não permitidas. Por favor, faça uma pergunta sobre Infinitepay ou matemática.",
-                    sources=[Config.KNOWLEDGE_BASE_URL],
-                    execution_time=time.time() - start_time,
-                    timestamp=chat_message.timestamp,
-                    user_message=chat_message.message
-                )
-            
-            if not self.qa_chain:
-                # Fallback response if RAG system is not available
-                return KnowledgeResponse(
-                    answer="Desculpe, mas a base de conhecimento está temporariamente indisponível. Tente novamente mais tarde ou visite a documentação do Infinitepay diretamente.",
-                    sources=[Config.KNOWLEDGE_BASE_URL],
-                    execution_time=time.time() - start_time,
-                    timestamp=chat_message.timestamp,
-                    user_message=chat_message.message
-                )
+            cached_response, query_vector = self._lookup_cached_answer(chat_message, prepared, start_time)
+            if cached_response:
+                return cached_response
             
             # Query the RAG system with sanitized message
-            result = self.qa_chain({"query": sanitized_message})
-            
-            # Extract answer and sources
-            answer = result["result"]
-            sources = self._extract_sources(result.get("source_documents", []))
+            result = self.qa_chain({"query": prepared})
             
-            # If no sources found, add the main documentation URL
-            if not sources:
-                sources = [Config.KNOWLEDGE_BASE_URL]
+            response = self._build_response(chat_message, result, start_time)
+            self._cache_answer(query_vector, response)
+            return response
             
-            execution_time = time.time() - start_time
+        except Exception as e:
+            return self._error_response(chat_message, e, start_time)
+    
+    async def aanswer_question(self, chat_message: ChatMessage) -> KnowledgeResponse:
+        """Answer user question using RAG system without blocking the event loop."""
+        start_time = time.time()
+        
+        try:
+            prepared = self._prepare_query(chat_message, start_time)
+            if isinstance(prepared, KnowledgeResponse):
+                return prepared
             
-            # Log execution with full observability
-            self.logger.log_agent_execution(
-                agent_type=AgentType.KNOWLEDGE,
-                message=chat_message.message,
-                execution_time=execution_time,
-                conversation_id=chat_message.conversation_id,
-                user_id=chat_message.user_id,
-                processed_content=answer[:200] + "..." if len(answer) > 200 else answer,
-                metadata={
-                    "sources_count": len(sources),
-                    "sources": sources,
-                    "rag_system_available": True
-                }
+            cached_response, query_vector = await asyncio.to_thread(
+                self._lookup_cached_answer, chat_message, prepared, start_time
             )
+            if cached_response:
+                return cached_response
             
-            return KnowledgeResponse(
-                answer=answer,
-                sources=sources,
-                execution_time=execution_time,
-                timestamp=chat_message.timestamp,
-                user_message=chat_message.message
-            )
+            # Query the RAG system with sanitized message
+            result = await self.qa_chain.ainvoke({"query": prepared})
             
-        except Exception as e:
-            execution_time = time.time() - start_time
-            self.logger.log_error(
-                AgentType.KNOWLEDGE, 
-                f"Knowledge query failed: {str(e)}",
-                conversation_id=chat_message.conversation_id,
-                user_id=chat_message.user_id,
-                execution_time=execution_time,
-                metadata={"error_type": "knowledge_query_failure"}
-            )
+            response = self._build_response(chat_message, result, start_time)
+            # Publishing goes through the sync Redis client, like the lookup
+            await asyncio.to_thread(self._cache_answer, query_vector, response)
+            return response
             
-            return KnowledgeResponse(
-                answer="Desculpe, ocorreu um erro ao processar sua pergunta. Tente reformular sua pergunta ou visite a documentação do Infinitepay para mais informações.",
-                sources=[Config.KNOWLEDGE_BASE_URL],
-                execution_time=execution_time,
-                timestamp=chat_message.timestamp,
-                user_message=chat_message.message
-            )
\ No newline at end of file
+        except Exception as e:
+            return self._error_response(chat_message, e, start_time)
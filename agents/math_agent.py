@@ -1,42 +1,117 @@
 """Math Agent - handles mathematical expressions and calculations."""
+import ast
 import time
 import re
-from typing import Union
+import operator
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Union, Tuple, Optional
 from openai import OpenAI
 from models import AgentType, MathResponse, ChatMessage
 from utils.logger import StructuredLogger
-from utils.security import SecurityValidator
+from utils.security import get_security_validator
+from utils.http_client import shared_http_client
+from utils.batcher import LLMBatcher
 from config import Config
 
+# Common question words and phrases stripped before extracting the expression
+_QUESTION_WORDS_RE = re.compile(
+    r"(?:how much is|what is|calculate|compute|solve|what's|can you|please|could you|would you)\s*",
+    re.IGNORECASE
+)
+
+# Runs of characters that can form an arithmetic expression
+_MATH_EXPRESSION_RE = re.compile(r"[\d+\-*/().\s]+")
+
+# Characters accepted by _safe_eval
+_SAFE_EXPRESSION_RE = re.compile(r"[0-9+\-*/.() ]*")
+
+# Arithmetic operators allowed by the expression evaluator
+_BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Pow: operator.pow,
+}
+_UNARY_OPERATORS = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+
+# Largest integer power result, in bits, so "9 ** 9 ** 9" or "((9 ** 999) ** 999) ** 99" cannot tie up a worker
+_MAX_POWER_BITS = 10_000
+
+def _check_power(base: Union[int, float], exponent: Union[int, float]):
+    """Reject an integer power whose result would exceed the bit budget before computing it."""
+    # Float powers overflow (and raise) on their own; negative exponents give floats
+    if type(base) is not int or type(exponent) is not int or exponent <= 0 or abs(base) <= 1:
+        return
+    if abs(base).bit_length() * exponent > _MAX_POWER_BITS:
+        raise ValueError("power result too large")
+
+def _evaluate_node(node: ast.expr) -> Union[int, float]:
+    """Evaluate a restricted arithmetic AST node."""
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        return node.value
+    
+    if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPERATORS:
+        left = _evaluate_node(node.left)
+        right = _evaluate_node(node.right)
+        if isinstance(node.op, ast.Pow):
+            _check_power(left, right)
+        return _BINARY_OPERATORS[type(node.op)](left, right)
+    
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPERATORS:
+        return _UNARY_OPERATORS[type(node.op)](_evaluate_node(node.operand))
+    
+    raise ValueError(f"unsupported element {type(node).__name__}")
+
+@lru_cache(maxsize=2048)
+def _evaluate_expression(expression: str) -> Union[int, float]:
+    """Parse and evaluate an expression; repeated expressions return the memoized result."""
+    return _evaluate_node(ast.parse(expression, mode="eval").body)
+
+# Explanation length budget: a base allowance plus a share per operator
+_MAX_EXPLANATION_TOKENS = 300
+_BASE_EXPLANATION_TOKENS = 60
+_TOKENS_PER_OPERATOR = 20
+_OPERATOR_RE = re.compile(r"[+\-*/()]")
+
+def _explanation_max_tokens(expression: str) -> int:
+    """Scale the explanation token budget with the size of the expression."""
+    operators = len(_OPERATOR_RE.findall(expression))
+    return min(_MAX_EXPLANATION_TOKENS, _BASE_EXPLANATION_TOKENS + _TOKENS_PER_OPERATOR * operators)
+
 class MathAgent:
     """Math agent that interprets and solves mathematical expressions."""
     
     def __init__(self):
-        self.client = OpenAI(api_key=Config.OPENAI_API_KEY)
+        self.client = OpenAI(api_key=Config.OPENAI_API_KEY, http_client=shared_http_client)
         self.logger = StructuredLogger("MathAgent")
-        self.security_validator = SecurityValidator()
+        self.security_validator = get_security_validator()
+        self.batcher = LLMBatcher(
+            self.client,
+            Config.MATH_MODEL,
+            max_batch=Config.LLM_BATCH_MAX_SIZE,
+            max_wait=Config.LLM_BATCH_MAX_WAIT_MS / 1000,
+            max_workers=Config.LLM_BATCH_MAX_WORKERS,
+            # Deterministic explanations are also eligible for OpenAI prompt caching
+            temperature=0,
+            max_tokens=_MAX_EXPLANATION_TOKENS
+        )
+        
+        # LLM explanations cached by expression: expression -> (explanation, created_at)
+        self.explanation_cache: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        # Read and written from request handlers and the batcher's threads
+        self.explanation_lock = threading.Lock()
     
     def _extract_math_expression(self, message: str) -> str:
         """Extract mathematical expression from user message."""
         # Remove common question words and phrases
-        question_patterns = [
-            r"how much is\s*",
-            r"what is\s*",
-            r"calculate\s*",
-            r"compute\s*",
-            r"solve\s*",
-            r"what's\s*",
-            r"can you\s*",
-            r"please\s*",
-            r"could you\s*",
-            r"would you\s*"
-        ]
-        
-        expression = message.strip()
-        
-        # Remove question patterns
-        for pattern in question_patterns:
-            expression = re.sub(pattern, "", expression, flags=re.IGNORECASE)
+        expression = _QUESTION_WORDS_RE.sub("", message.strip())
         
         # Remove question marks and extra whitespace
         expression = expression.rstrip("?").strip()
@@ -46,8 +121,7 @@ class MathAgent:
             return expression
         
         # Extract mathematical expression using regex
-        math_pattern = r"[\d\+\-\*\/\(\)\.\s]+"
-        matches = re.findall(math_pattern, expression)
+        matches = _MATH_EXPRESSION_RE.findall(expression)
         
         if matches:
             # Take the longest match that looks like a math expression
@@ -67,12 +141,11 @@ class MathAgent:
             expression = expression.replace("×", "*").replace("÷", "/")
             
             # Validate that the expression only contains safe characters
-            safe_chars = set("0123456789+-*/.() ")
-            if not all(c in safe_chars for c in expression):
+            if not _SAFE_EXPRESSION_RE.fullmatch(expression):
                 return "Invalid characters in expression"
             
-            # Evaluate the expression
-            result = eval(expression)
+            # Evaluate the expression without going through eval()
+            result = _evaluate_expression(expression)
             
             # Ensure result is a number
             if isinstance(result, (int, float)):
@@ -85,134 +158,223 @@ class MathAgent:
         except Exception as e:
             return f"Error evaluating expression: {str(e)}"
     
-    def _get_llm_interpretation(self, message: str, expression: str) -> str:
-        """Use LLM to interpret and explain the mathematical expression."""
-        try:
-            prompt = f"""
-            The user asked: "{message}"
-            The mathematical expression extracted is: "{expression}"
+    def _build_interpretation_prompt(self, expression: str) -> str:
+        """Build the LLM prompt asking for a step-by-step explanation.
+        
+        Only the evaluated expression (digits, operators and parentheses) goes into the
+        prompt: it is batched with other users' prompts and cached under the expression.
+        """
+        return f"""
+            The mathematical expression is: "{expression}"
             
             Please provide a clear, step-by-step explanation of how to solve this mathematical expression.
             Include the final answer and show your work.
             Be concise but thorough.
             """
-            
-            response = self.client.chat.completions.create(
-                model=Config.MATH_MODEL,
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.1,
-                max_tokens=300
+    
+    def _get_cached_explanation(self, cache_key: str) -> Optional[str]:
+        """Return a cached explanation if it has not expired."""
+        with self.explanation_lock:
+            cached = self.explanation_cache.get(cache_key)
+            if cached and time.time() - cached[1] <= Config.SEMANTIC_CACHE_TTL:
+                self.explanation_cache.move_to_end(cache_key)
+                return cached[0]
+        return None
+    
+    def _cache_explanation(self, cache_key: str, explanation: str):
+        """Store an explanation, evicting the least recently used entries."""
+        with self.explanation_lock:
+            self.explanation_cache[cache_key] = (explanation, time.time())
+            self.explanation_cache.move_to_end(cache_key)
+            while len(self.explanation_cache) > Config.SEMANTIC_CACHE_SIZE:
+                self.explanation_cache.popitem(last=False)
+    
+    def _interpretation_fallback(self, expression: str, error: Exception) -> str:
+        """Log an LLM failure and return a generic explanation."""
+        self.logger.log_error(AgentType.MATH, f"LLM interpretation failed: {str(error)}")
+        return f"I can solve the expression {expression}, but I had trouble generating a detailed explanation."
+    
+    def _get_llm_interpretation(self, expression: str) -> str:
+        """Use LLM to interpret and explain the mathematical expression."""
+        # The key is exactly the expression the prompt is built from
+        cache_key = " ".join(expression.split())
+        cached = self._get_cached_explanation(cache_key)
+        if cached:
+            return cached
+        
+        try:
+            # Concurrent explanations are coalesced into a single completion
+            explanation = self.batcher.submit(
+                self._build_interpretation_prompt(cache_key),
+                max_tokens=_explanation_max_tokens(cache_key)
             )
-            
-            return response.choices[0].message.content.strip()
+            self._cache_explanation(cache_key, explanation)
+            return explanation
             
         except Exception as e:
-            self.logger.log_error(AgentType.MATH, f"LLM interpretation failed: {str(e)}")
-            return f"I can solve the expression {expression}, but I had trouble generating a detailed explanation."
+            return self._interpretation_fallback(expression, e)
     
-    def solve_math_problem(self, chat_message: ChatMessage) -> MathResponse:
-        """Solve mathematical problem from user message."""
-        start_time = time.time()
+    async def _aget_llm_interpretation(self, expression: str) -> str:
+        """Async variant of _get_llm_interpretation that does not block the event loop."""
+        # The key is exactly the expression the prompt is built from
+        cache_key = " ".join(expression.split())
+        cached = self._get_cached_explanation(cache_key)
+        if cached:
+            return cached
         
         try:
-            # Sanitize input message
-            sanitized_message = self.security_validator.sanitize_input(chat_message.message)
-            
-            # Check for prompt injection
-            injection_check = self.security_validator.detect_prompt_injection(sanitized_message)
-            if injection_check["is_suspicious"]:
-                self.logger.log_info(
-                    "Prompt injection detected in math query",
-                    metadata={
-                        "confidence": injection_check["confidence"],
-                        "patterns": injection_check["patterns_found"]
-                    }
-                )
-                
-                return MathResponse(
-                    answer="Desculpe, mas sua pergunta contém instruções não permitidas. Por favor, faça uma pergunta sobre matemática ou Infinitepay.",
-                    expression="",
-                    result=0.0,
-                    execution_time=time.time() - start_time,
-                    timestamp=chat_message.timestamp,
-                    user_message=chat_message.message
-                )
-            
-            # Extract mathematical expression from sanitized message
-            expression = self._extract_math_expression(sanitized_message)
-            
-            if not expression:
-                return MathResponse(
-                    answer="I couldn't find a mathematical expression in your message. Please provide a clear math problem.",
-                    expression="",
-                    result=0.0,
-                    execution_time=time.time() - start_time,
-                    timestamp=chat_message.timestamp,
-                    user_message=chat_message.message
-                )
-            
-            # Solve the expression
-            result = self._safe_eval(expression)
-            
-            if isinstance(result, str):
-                # Error occurred during evaluation
-                return MathResponse(
-                    answer=f"I encountered an error: {result}",
-                    expression=expression,
-                    result=0.0,
-                    execution_time=time.time() - start_time,
-                    timestamp=chat_message.timestamp,
-                    user_message=chat_message.message
-                )
-            
-            # Get LLM interpretation for better explanation
-            explanation = self._get_llm_interpretation(sanitized_message, expression)
-            
-            # Format the answer
-            answer = f"**Expression:** {expression}\n**Result:** {result}\n\n**Explanation:**\n{explanation}"
-            
-            execution_time = time.time() - start_time
+            explanation = await self.batcher.asubmit(
+                self._build_interpretation_prompt(cache_key),
+                max_tokens=_explanation_max_tokens(cache_key)
+            )
+            self._cache_explanation(cache_key, explanation)
+            return explanation
             
-            # Log execution with full observability
-            self.logger.log_agent_execution(
-                agent_type=AgentType.MATH,
-                message=chat_message.message,
-                execution_time=execution_time,
-                conversation_id=chat_message.conversation_id,
-                user_id=chat_message.user_id,
-                processed_content=f"Expression: {expression}, Result: {result}",
+        except Exception as e:
+            return self._interpretation_fallback(expression, e)
+    
+    def _prepare_problem(self, chat_message: ChatMessage,
+                         start_time: float) -> Union[MathResponse, Tuple[str, float]]:
+        """Validate the message and evaluate its expression.
+        
+        Returns a final MathResponse when no explanation is needed, otherwise the
+        extracted expression and its result.
+        """
+        # Sanitize input message and check it for prompt injection
+        sanitized_message, injection_check = self.security_validator.scan_and_sanitize(chat_message.message)
+        if injection_check["is_suspicious"]:
+            self.logger.log_info(
+                "Prompt injection detected in math query",
                 metadata={
-                    "expression": expression,
-                    "result": result,
-                    "calculation_successful": True
+                    "confidence": injection_check["confidence"],
+                    "patterns": injection_check["patterns_found"]
                 }
             )
             
             return MathResponse(
-                answer=answer,
-                expression=expression,
-                result=result,
-                execution_time=execution_time,
+                answer="Desculpe, mas sua pergunta contém instruções não permitidas. Por favor, faça uma pergunta sobre matemática ou Infinitepay.",
+                expression="",
+                result=0.0,
+                execution_time=time.time() - start_time,
                 timestamp=chat_message.timestamp,
                 user_message=chat_message.message
             )
-            
-        except Exception as e:
-            execution_time = time.time() - start_time
-            self.logger.log_error(
-                AgentType.MATH, 
-                f"Math problem solving failed: {str(e)}",
-                conversation_id=chat_message.conversation_id,
-                user_id=chat_message.user_id,
-                execution_time=execution_time,
-                metadata={"error_type": "math_processing_failure"}
-            )
-            
+        
+        # Extract mathematical expression from sanitized message
+        expression = self._extract_math_expression(sanitized_message)
+        
+        if not expression:
             return MathResponse(
-                answer="Desculpe, ocorreu um erro ao processar seu problema matemático. Tente reformular sua pergunta.",
+                answer="I couldn't find a mathematical expression in your message. Please provide a clear math problem.",
                 expression="",
                 result=0.0,
-                execution_time=execution_time,
+                execution_time=time.time() - start_time,
                 timestamp=chat_message.timestamp,
                 user_message=chat_message.message
             )
+        
+        # Solve the expression
+        result = self._safe_eval(expression)
+        
+        if isinstance(result, str):
+            # Error occurred during evaluation
+            return MathResponse(
+                answer=f"I encountered an error: {result}",
+                expression=expression,
+                result=0.0,
+                execution_time=time.time() - start_time,
+                timestamp=chat_message.timestamp,
+                user_message=chat_message.message
+            )
+        
+        return expression, result
+    
+    def _build_response(self, chat_message: ChatMessage, expression: str, result: float,
+                        explanation: str, start_time: float) -> MathResponse:
+        """Format the final answer and log the execution."""
+        answer = f"**Expression:** {expression}\n**Result:** {result}\n\n**Explanation:**\n{explanation}"
+        
+        execution_time = time.time() - start_time
+        
+        # Log execution with full observability
+        self.logger.log_agent_execution(
+            agent_type=AgentType.MATH,
+            message=chat_message.message,
+            execution_time=execution_time,
+            conversation_id=chat_message.conversation_id,
+            user_id=chat_message.user_id,
+            processed_content=f"Expression: {expression}, Result: {result}",
+            metadata={
+                "expression": expression,
+                "result": result,
+                "calculation_successful": True
+            }
+        )
+        
+        return MathResponse(
+            answer=answer,
+            expression=expression,
+            result=result,
+            execution_time=execution_time,
+            timestamp=chat_message.timestamp,
+            user_message=chat_message.message
+        )
+    
+    def _error_response(self, chat_message: ChatMessage, error: Exception, start_time: float) -> MathResponse:
+        """Log a processing failure and return a safe response."""
+        execution_time = time.time() - start_time
+        self.logger.log_error(
+            AgentType.MATH, 
+            f"Math problem solving failed: {str(error)}",
+            conversation_id=chat_message.conversation_id,
+            user_id=chat_message.user_id,
+            execution_time=execution_time,
+            metadata={"error_type": "math_processing_failure"}
+        )
+        
+        return MathResponse(
+            answer="Desculpe, ocorreu um erro ao processar seu problema matemático. Tente reformular sua pergunta.",
+            expression="",
+            result=0.0,
+            execution_time=execution_time,
+            timestamp=chat_message.timestamp,
+            user_message=chat_message.message
+        )
+    
+    def solve_math_problem(self, chat_message: ChatMessage) -> MathResponse:
+        """Solve mathematical problem from user message."""
+        start_time = time.time()
+        
+        try:
+            prepared = self._prepare_problem(chat_message, start_time)
+            if isinstance(prepared, MathResponse):
+                return prepared
+            
+            expression, result = prepared
+            
+            # Get LLM interpretation for better explanation
+            explanation = self._get_llm_interpretation(expression)
+            
+            return self._build_response(chat_message, expression, result, explanation, start_time)
+            
+        except Exception as e:
+            return self._error_response(chat_message, e, start_time)
+    
+    async def asolve_math_problem(self, chat_message: ChatMessage) -> MathResponse:
+        """Solve mathematical problem from user message without blocking the event loop."""
+        start_time = time.time()
+        
+        try:
+            prepared = self._prepare_problem(chat_message, start_time)
+            if isinstance(prepared, MathResponse):
+                return prepared
+            
+            expression, result = prepared
+            
+            # Get LLM interpretation for better explanation
+            explanation = await self._aget_llm_interpretation(expression)
+            
+            return self._build_response(chat_message, expression, result, explanation, start_time)
+            
+        except Exception as e:
+            return self._error_response(chat_message, e, start_time)
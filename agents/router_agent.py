@@ -1,106 +1,299 @@
 """Router Agent - decides which agent should handle user messages."""
+import json
+import re
 import time
-from typing import Tuple
-from openai import OpenAI
+import asyncio
+import threading
+from typing import Any, Dict, Optional, Tuple
+import numpy as np
+from openai import AsyncOpenAI, OpenAI
 from models import AgentType, RouterDecision, ChatMessage
 from utils.logger import StructuredLogger
-from utils.security import SecurityValidator
+from utils.security import get_security_validator
+from utils.http_client import shared_async_http_client, shared_http_client
+from utils.embeddings import get_embeddings
+from utils.semantic_cache import SemanticCache, get_cache_redis
 from config import Config
 
+# Characters treated as arithmetic operators by the rule-based router
+_OPERATOR_CHARS = frozenset("+-*/=()")
+
+# Keywords that indicate mathematical operations
+_MATH_KEYWORDS = [
+    "calculate", "compute", "solve", "math", "mathematical",
+    "addition", "subtraction", "multiplication", "division",
+    "plus", "minus", "times", "divided", "equals", "=",
+    "sum", "difference", "product", "quotient", "percentage",
+    "percent", "%", "+", "-", "*", "/", "(", ")"
+]
+
+# Keywords that indicate knowledge base queries
+_KNOWLEDGE_KEYWORDS = [
+    "help", "how", "what", "where", "when", "why", "explain",
+    "documentation", "guide", "tutorial", "support", "api",
+    "infinitepay", "payment", "integration", "webhook",
+    "authentication", "token", "credentials"
+]
+
+# Each keyword list compiled once into one alternation, matched as substrings
+_MATH_KEYWORDS_RE = re.compile("|".join(map(re.escape, _MATH_KEYWORDS)))
+_KNOWLEDGE_KEYWORDS_RE = re.compile("|".join(map(re.escape, _KNOWLEDGE_KEYWORDS)))
+
+# Messages routed without the cache or the LLM: bare arithmetic and questions about InfinitePay itself
+_PURE_MATH_RE = re.compile(r'[\d\s+\-*/().=%]+')
+_INFINITEPAY_QUESTION_RE = re.compile(
+    r"(what\s+is|what's|o\s+que\s+(é|e)|como\s+funciona)\s+(a\s+)?infinite\s*pay",
+    re.IGNORECASE
+)
+
+# Labeled example messages; a close enough match routes without an LLM call
+_ROUTING_EXEMPLARS = [
+    ("Quanto é 65 x 3.11?", AgentType.MATH),
+    ("Quanto é 70 + 12?", AgentType.MATH),
+    ("Qual o resultado de (42 * 2) / 6?", AgentType.MATH),
+    ("Calcule 15% de 200", AgentType.MATH),
+    ("Quanto dá 1000 dividido por 8?", AgentType.MATH),
+    ("Qual é a raiz quadrada de 144?", AgentType.MATH),
+    ("Me ajuda a resolver 3 * (4 + 5)", AgentType.MATH),
+    ("Quanto é 2 elevado a 10?", AgentType.MATH),
+    ("Some 125 com 375", AgentType.MATH),
+    ("Qual a diferença entre 900 e 457?", AgentType.MATH),
+    ("How much is 65 x 3.11?", AgentType.MATH),
+    ("Calculate 70 + 12", AgentType.MATH),
+    ("What is 100 - 25?", AgentType.MATH),
+    ("Solve (42 * 2) / 6", AgentType.MATH),
+    ("What is 15 percent of 80?", AgentType.MATH),
+    ("Multiply 12 by 7", AgentType.MATH),
+    ("What is 2 to the power of 8?", AgentType.MATH),
+    ("Divide 144 by 12", AgentType.MATH),
+    ("What's the sum of 250 and 750?", AgentType.MATH),
+    ("Compute 3.5 * 4.2", AgentType.MATH),
+    ("Quais as taxas da maquininha da InfinitePay?", AgentType.KNOWLEDGE),
+    ("Como faço para receber pagamentos com Pix?", AgentType.KNOWLEDGE),
+    ("Como funciona o link de pagamento?", AgentType.KNOWLEDGE),
+    ("Qual o prazo para o dinheiro cair na conta?", AgentType.KNOWLEDGE),
+    ("Como integro minha loja com a API da InfinitePay?", AgentType.KNOWLEDGE),
+    ("Como configuro webhooks de pagamento?", AgentType.KNOWLEDGE),
+    ("Onde encontro minhas credenciais de API?", AgentType.KNOWLEDGE),
+    ("Como peço uma maquininha?", AgentType.KNOWLEDGE),
+    ("A InfinitePay aceita boleto?", AgentType.KNOWLEDGE),
+    ("Como faço para antecipar recebíveis?", AgentType.KNOWLEDGE),
+    ("Como cancelo uma venda no cartão?", AgentType.KNOWLEDGE),
+    ("Como falo com o suporte?", AgentType.KNOWLEDGE),
+    ("What are the card machine fees?", AgentType.KNOWLEDGE),
+    ("How do I integrate with the Infinitepay API?", AgentType.KNOWLEDGE),
+    ("How do I receive payments with Pix?", AgentType.KNOWLEDGE),
+    ("Where can I find the API documentation?", AgentType.KNOWLEDGE),
+    ("How do webhooks work?", AgentType.KNOWLEDGE),
+    ("How do I get my API credentials?", AgentType.KNOWLEDGE),
+    ("Which payment methods are supported?", AgentType.KNOWLEDGE),
+    ("How do I contact support?", AgentType.KNOWLEDGE),
+]
+
+def _decode_decision(values: list) -> Tuple[AgentType, float, str]:
+    """Rebuild a cached (agent_type, confidence, reasoning) decision."""
+    agent, confidence, reasoning = values
+    return AgentType(agent), confidence, reasoning
+
 class RouterAgent:
     """Router agent that decides which specialized agent should handle user messages."""
     
     def __init__(self):
-        self.client = OpenAI(api_key=Config.OPENAI_API_KEY)
+        self.client = OpenAI(api_key=Config.OPENAI_API_KEY, http_client=shared_http_client)
+        self.async_client = AsyncOpenAI(api_key=Config.OPENAI_API_KEY, http_client=shared_async_http_client)
         self.logger = StructuredLogger("RouterAgent")
-        self.security_validator = SecurityValidator()
-        
-        # Keywords that indicate mathematical operations
-        self.math_keywords = [
-            "calculate", "compute", "solve", "math", "mathematical",
-            "addition", "subtraction", "multiplication", "division",
-            "plus", "minus", "times", "divided", "equals", "=",
-            "sum", "difference", "product", "quotient", "percentage",
-            "percent", "%", "+", "-", "*", "/", "(", ")"
-        ]
-        
-        # Keywords that indicate knowledge base queries
-        self.knowledge_keywords = [
-            "help", "how", "what", "where", "when", "why", "explain",
-            "documentation", "guide", "tutorial", "support", "api",
-            "infinitepay", "payment", "integration", "webhook",
-            "authentication", "token", "credentials"
-        ]
+        self.security_validator = get_security_validator()
+        
+        # LLM routing decisions reused for near-identical messages: (agent, confidence, reasoning)
+        self.decision_cache = self._create_decision_cache() if Config.OPENAI_API_KEY else None
+        
+        # Normalized exemplar embeddings, computed on first use
+        self.exemplar_vectors: Optional[np.ndarray] = None
+        self.exemplar_lock = threading.Lock()
     
     def _is_math_expression(self, message: str) -> bool:
         """Check if the message contains mathematical expressions."""
-        message_lower = message.lower()
+        # Both rules need a number, so messages without digits stop here
+        if not any(char.isdigit() for char in message):
+            return False
         
         # Check for mathematical operators
-        has_operators = any(op in message for op in ["+", "-", "*", "/", "=", "(", ")"])
+        if not _OPERATOR_CHARS.isdisjoint(message):
+            return True
         
         # Check for math keywords
-        has_math_keywords = any(keyword in message_lower for keyword in self.math_keywords)
-        
-        # Check for numbers
-        has_numbers = any(char.isdigit() for char in message)
-        
-        return (has_operators and has_numbers) or (has_math_keywords and has_numbers)
+        return _MATH_KEYWORDS_RE.search(message.lower()) is not None
     
     def _is_knowledge_query(self, message: str) -> bool:
         """Check if the message is a knowledge base query."""
-        message_lower = message.lower()
-        
         # Check for knowledge keywords
-        has_knowledge_keywords = any(keyword in message_lower for keyword in self.knowledge_keywords)
+        has_knowledge_keywords = _KNOWLEDGE_KEYWORDS_RE.search(message.lower()) is not None
         
         # Check for question patterns
         is_question = message.strip().endswith("?")
         
         return has_knowledge_keywords or is_question
     
-    def _get_llm_decision(self, message: str) -> Tuple[AgentType, float, str]:
-        """Use LLM to make routing decision with confidence score."""
+    def _create_decision_cache(self) -> SemanticCache:
+        """Create the semantic cache of LLM routing decisions, shared across workers via Redis."""
+        return SemanticCache(
+            get_embeddings(),
+            threshold=Config.ROUTER_CACHE_THRESHOLD,
+            redis_client=get_cache_redis(),
+            namespace="router",
+            encode=lambda decision: json.dumps([decision[0].value, decision[1], decision[2]]),
+            decode=lambda payload: _decode_decision(json.loads(payload))
+        )
+    
+    def _embed_for_cache(self, message: str):
+        """Embed a message for the decision cache; None disables caching for this call."""
+        if not self.decision_cache:
+            return None
+        
         try:
-            # Create secure prompt
-            system_prompt = """
-            You are a routing agent that decides which specialized agent should handle user messages.
-            
-            Available agents:
-            1. MATH_AGENT: For mathematical calculations, expressions, and arithmetic operations
-            2. KNOWLEDGE_AGENT: For questions about Infinitepay API, documentation, and general help
-            
-            Analyze the user message and respond with JSON format:
-            {
-                "agent": "MATH_AGENT" or "KNOWLEDGE_AGENT",
-                "confidence": 0.0 to 1.0,
-                "reasoning": "Brief explanation of why this agent was chosen"
-            }
-            """
-            
-            prompt = self.security_validator.create_safe_prompt(message, system_prompt)
-            
-            response = self.client.chat.completions.create(
-                model=Config.ROUTER_MODEL,
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.1,
-                max_tokens=200
-            )
+            return self.decision_cache.embed(message)
+        except Exception as e:
+            self.logger.log_error(None, f"Routing cache lookup failed: {str(e)}")
+            return None
+    
+    def _get_exemplar_vectors(self) -> Optional[np.ndarray]:
+        """Embed the routing exemplars once, in a single batch."""
+        if self.exemplar_vectors is None:
+            with self.exemplar_lock:
+                if self.exemplar_vectors is None:
+                    try:
+                        texts = [text for text, _ in _ROUTING_EXEMPLARS]
+                        vectors = np.asarray(self.decision_cache.embeddings.embed_documents(texts), dtype=np.float32)
+                        self.exemplar_vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+                    except Exception as e:
+                        self.logger.log_error(None, f"Routing exemplar embedding failed: {str(e)}")
+        return self.exemplar_vectors
+    
+    def _classify_by_exemplars(self, query_vector: np.ndarray) -> Optional[Tuple[AgentType, float, str]]:
+        """Route by the most similar labeled exemplar, if it is similar enough."""
+        exemplar_vectors = self._get_exemplar_vectors()
+        if exemplar_vectors is None:
+            return None
+        
+        similarities = exemplar_vectors @ query_vector[0]
+        best = int(similarities.argmax())
+        similarity = float(similarities[best])
+        if similarity < Config.ROUTER_EXEMPLAR_THRESHOLD:
+            return None
+        
+        text, agent_type = _ROUTING_EXEMPLARS[best]
+        return agent_type, similarity, f"Similar to routing example: {text}"
+    
+    def _fast_path_decision(self, message: str) -> Optional[Tuple[AgentType, float, str]]:
+        """Route messages that are unambiguous from their text alone."""
+        stripped = message.strip()
+        if _PURE_MATH_RE.fullmatch(stripped) and self._is_math_expression(stripped):
+            return AgentType.MATH, 0.99, "Pure arithmetic expression"
+        if _INFINITEPAY_QUESTION_RE.match(stripped):
+            return AgentType.KNOWLEDGE, 0.95, "Question about InfinitePay"
+        return None
+    
+    def _lookup_decision(self, message: str) -> Tuple[Optional[Tuple[AgentType, float, str]], str, Optional[np.ndarray]]:
+        """Return a decision from the fast path, the cache or the exemplars, how it was made, and the message embedding."""
+        fast_decision = self._fast_path_decision(message)
+        if fast_decision:
+            return fast_decision, "rule", None
+        
+        # Near-duplicate messages reuse an earlier decision instead of calling the LLM
+        query_vector = self._embed_for_cache(message)
+        if query_vector is None:
+            return None, "llm", None
+        
+        cached_decision = self.decision_cache.get(query_vector)
+        if cached_decision:
+            return cached_decision, "cache", query_vector
+        
+        # Messages close to a labeled exemplar are routed without the LLM
+        exemplar_decision = self._classify_by_exemplars(query_vector)
+        if exemplar_decision:
+            return exemplar_decision, "exemplar", query_vector
+        return None, "llm", query_vector
+    
+    def _routing_request(self, message: str) -> Dict[str, Any]:
+        """Build the chat completion arguments for a routing decision."""
+        # Create secure prompt
+        system_prompt = """
+        You are a routing agent that decides which specialized agent should handle user messages.
+        
+        Available agents:
+        1. MATH_AGENT: For mathematical calculations, expressions, and arithmetic operations
+        2. KNOWLEDGE_AGENT: For questions about Infinitepay API, documentation, and general help
+        
+        Analyze the user message and respond with JSON format:
+        {
+            "agent": "MATH_AGENT" or "KNOWLEDGE_AGENT",
+            "confidence": 0.0 to 1.0,
+            "reasoning": "Brief explanation of why this agent was chosen"
+        }
+        """
+        
+        prompt = self.security_validator.create_safe_prompt(message, system_prompt)
+        
+        return {
+            "model": Config.ROUTER_MODEL,
+            "messages": [{"role": "user", "content": prompt}],
+            "temperature": 0.1,
+            "max_tokens": 200
+        }
+    
+    def _parse_llm_decision(self, response) -> Tuple[AgentType, float, str]:
+        """Parse the LLM routing response."""
+        result = json.loads(response.choices[0].message.content.strip())
+        
+        agent_type = AgentType.MATH if result["agent"] == "MATH_AGENT" else AgentType.KNOWLEDGE
+        confidence = float(result["confidence"])
+        reasoning = result["reasoning"]
+        
+        return agent_type, confidence, reasoning
+    
+    def _cache_decision(self, query_vector: Optional[np.ndarray], decision: Tuple[AgentType, float, str]):
+        """Store an LLM decision in the semantic cache, which also publishes it through Redis."""
+        if query_vector is not None:
+            self.decision_cache.put(query_vector, decision)
+    
+    def _get_llm_decision(self, message: str) -> Tuple[AgentType, float, str, str]:
+        """Use LLM to make routing decision with confidence score.
+        
+        Returns the agent type, confidence and reasoning, plus the routing method that
+        decided: "rule", "cache", "exemplar", "llm" or "fallback" (rules after an LLM failure).
+        """
+        try:
+            decision, routing_method, query_vector = self._lookup_decision(message)
+            if decision:
+                return (*decision, routing_method)
             
-            # Parse LLM response
-            import json
-            result = json.loads(response.choices[0].message.content.strip())
+            response = self.client.chat.completions.create(**self._routing_request(message))
+            decision = self._parse_llm_decision(response)
+            self._cache_decision(query_vector, decision)
+            return (*decision, "llm")
             
-            agent_type = AgentType.MATH if result["agent"] == "MATH_AGENT" else AgentType.KNOWLEDGE
-            confidence = float(result["confidence"])
-            reasoning = result["reasoning"]
+        except Exception as e:
+            self.logger.log_error(AgentType.KNOWLEDGE, f"LLM decision failed: {str(e)}")
+            # Fallback to rule-based decision
+            return (*self._rule_based_decision(message), "fallback")
+    
+    async def _aget_llm_decision(self, message: str) -> Tuple[AgentType, float, str, str]:
+        """Async variant of _get_llm_decision that awaits the LLM call on the event loop."""
+        try:
+            # The cache lookup embeds through a sync client, so keep it off the event loop
+            decision, routing_method, query_vector = await asyncio.to_thread(self._lookup_decision, message)
+            if decision:
+                return (*decision, routing_method)
             
-            return agent_type, confidence, reasoning
+            response = await self.async_client.chat.completions.create(**self._routing_request(message))
+            decision = self._parse_llm_decision(response)
+            await asyncio.to_thread(self._cache_decision, query_vector, decision)
+            return (*decision, "llm")
             
         except Exception as e:
             self.logger.log_error(AgentType.KNOWLEDGE, f"LLM decision failed: {str(e)}")
             # Fallback to rule-based decision
-            return self._rule_based_decision(message)
+            return (*self._rule_based_decision(message), "fallback")
     
     def _rule_based_decision(self, message: str) -> Tuple[AgentType, float, str]:
         """Fallback rule-based decision making."""
@@ -112,55 +305,73 @@ class RouterAgent:
             # Default to knowledge agent for general queries
             return AgentType.KNOWLEDGE, 0.5, "Default to knowledge agent for general queries"
     
+    def _build_decision(self, chat_message: ChatMessage, agent_type: AgentType, confidence: float,
+                        reasoning: str, routing_method: str, start_time: float) -> RouterDecision:
+        """Create the routing decision and log it."""
+        decision = RouterDecision(
+            agent_type=agent_type,
+            confidence=confidence,
+            reasoning=reasoning,
+            timestamp=chat_message.timestamp,
+            user_message=chat_message.message
+        )
+        
+        # Log the decision with full observability
+        execution_time = time.time() - start_time
+        self.logger.log_agent_decision(
+            agent_type=agent_type,
+            confidence=confidence,
+            reasoning=reasoning,
+            user_message=chat_message.message,
+            conversation_id=chat_message.conversation_id,
+            user_id=chat_message.user_id,
+            execution_time=execution_time,
+            decision=agent_type.value,
+            metadata={"routing_method": routing_method}
+        )
+        
+        return decision
+    
+    def _fallback_decision(self, chat_message: ChatMessage, error: Exception, start_time: float) -> RouterDecision:
+        """Log a routing failure and default to the knowledge agent."""
+        execution_time = time.time() - start_time
+        self.logger.log_error(
+            AgentType.KNOWLEDGE, 
+            f"Routing failed: {str(error)}",
+            conversation_id=chat_message.conversation_id,
+            user_id=chat_message.user_id,
+            execution_time=execution_time,
+            metadata={"error_type": "routing_failure"}
+        )
+        
+        # Return fallback decision
+        return RouterDecision(
+            agent_type=AgentType.KNOWLEDGE,
+            confidence=0.1,
+            reasoning="Error occurred, defaulting to knowledge agent",
+            timestamp=chat_message.timestamp,
+            user_message=chat_message.message
+        )
+    
     def route_message(self, chat_message: ChatMessage) -> RouterDecision:
         """Route user message to appropriate agent."""
         start_time = time.time()
         
         try:
             # Get routing decision
-            agent_type, confidence, reasoning = self._get_llm_decision(chat_message.message)
-            
-            # Create decision object
-            decision = RouterDecision(
-                agent_type=agent_type,
-                confidence=confidence,
-                reasoning=reasoning,
-                timestamp=chat_message.timestamp,
-                user_message=chat_message.message
-            )
-            
-            # Log the decision with full observability
-            execution_time = time.time() - start_time
-            self.logger.log_agent_decision(
-                agent_type=agent_type,
-                confidence=confidence,
-                reasoning=reasoning,
-                user_message=chat_message.message,
-                conversation_id=chat_message.conversation_id,
-                user_id=chat_message.user_id,
-                execution_time=execution_time,
-                decision=agent_type.value,
-                metadata={"routing_method": "llm"}
-            )
-            
-            return decision
+            agent_type, confidence, reasoning, routing_method = self._get_llm_decision(chat_message.message)
+            return self._build_decision(chat_message, agent_type, confidence, reasoning, routing_method, start_time)
             
         except Exception as e:
-            execution_time = time.time() - start_time
-            self.logger.log_error(
-                AgentType.KNOWLEDGE, 
-                f"Routing failed: {str(e)}",
-                conversation_id=chat_message.conversation_id,
-                user_id=chat_message.user_id,
-                execution_time=execution_time,
-                metadata={"error_type": "routing_failure"}
-            )
+            return self._fallback_decision(chat_message, e, start_time)
+    
+    async def aroute_message(self, chat_message: ChatMessage) -> RouterDecision:
+        """Route user message to appropriate agent without blocking the event loop."""
+        start_time = time.time()
+        
+        try:
+            agent_type, confidence, reasoning, routing_method = await self._aget_llm_decision(chat_message.message)
+            return self._build_decision(chat_message, agent_type, confidence, reasoning, routing_method, start_time)
             
-            # Return fallback decision
-            return RouterDecision(
-                agent_type=AgentType.KNOWLEDGE,
-                confidence=0.1,
-                reasoning="Error occurred, defaulting to knowledge agent",
-                timestamp=chat_message.timestamp,
-                user_message=chat_message.message
-            )
+        except Exception as e:
+            return self._fallback_decision(chat_message, e, start_time)
@@ -12,6 +12,42 @@ class Config:
     
     # Knowledge base configuration
     KNOWLEDGE_BASE_URL = "https://ajuda.infinitepay.io/pt-BR/"
+    SCRAPER_MAX_WORKERS = int(os.getenv("SCRAPER_MAX_WORKERS", "8"))
+    FAISS_DIR = os.getenv("FAISS_DIR", "data/faiss_index")
+    # Prebuilt index of the fallback content, used when scraping fails
+    FAISS_FALLBACK_DIR = os.getenv("FAISS_FALLBACK_DIR", "data/faiss_fallback")
+    EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-ada-002")
+    # faiss.index_factory description, or "auto" to pick one from the corpus size
+    FAISS_INDEX_FACTORY = os.getenv("FAISS_INDEX_FACTORY", "auto")
+    FAISS_IVF_MIN_VECTORS = int(os.getenv("FAISS_IVF_MIN_VECTORS", "10000"))
+    # Vector encoding of the small-corpus HNSW index: SQfp16 (2 bytes/dim) or SQ8 (1 byte/dim, trained)
+    FAISS_HNSW_ENCODING = os.getenv("FAISS_HNSW_ENCODING", "SQfp16")
+    FAISS_HNSW_EF_SEARCH = int(os.getenv("FAISS_HNSW_EF_SEARCH", "64"))
+    FAISS_IVF_NPROBE = int(os.getenv("FAISS_IVF_NPROBE", "8"))
+    EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "512"))
+    EMBEDDING_MAX_WORKERS = int(os.getenv("EMBEDDING_MAX_WORKERS", "4"))
+    QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "4096"))
+    # Chunk sizes are in cl100k_base tokens
+    CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "128"))
+    CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "16"))
+    
+    # Retrieval configuration (MMR over fetch_k candidates, keeping k above the similarity floor)
+    RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", "2"))
+    RETRIEVAL_FETCH_K = int(os.getenv("RETRIEVAL_FETCH_K", "10"))
+    RETRIEVAL_LAMBDA_MULT = float(os.getenv("RETRIEVAL_LAMBDA_MULT", "0.5"))
+    RETRIEVAL_SIMILARITY_THRESHOLD = float(os.getenv("RETRIEVAL_SIMILARITY_THRESHOLD", "0.75"))
+    # Chunks this many times farther from the query than the best hit are left out of the prompt
+    RETRIEVAL_DISTANCE_GAP_RATIO = float(os.getenv("RETRIEVAL_DISTANCE_GAP_RATIO", "2.0"))
+    
+    # Response cache configuration
+    SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.93"))
+    SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "1024"))
+    SEMANTIC_CACHE_TTL = int(os.getenv("SEMANTIC_CACHE_TTL", "3600"))
+    # Share cached answers between workers through Redis when it is reachable
+    SEMANTIC_CACHE_REDIS = os.getenv("SEMANTIC_CACHE_REDIS", "true").lower() == "true"
+    ROUTER_CACHE_THRESHOLD = float(os.getenv("ROUTER_CACHE_THRESHOLD", "0.95"))
+    # Cosine similarity to a labeled routing exemplar needed to skip the LLM (tuned for ada-002)
+    ROUTER_EXEMPLAR_THRESHOLD = float(os.getenv("ROUTER_EXEMPLAR_THRESHOLD", "0.9"))
     
     # Redis configuration
     REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
@@ -21,13 +57,25 @@ class Config:
     
     # Logging configuration
     LOG_LEVEL = "INFO"
+    # Repeated security warnings log the first LOG_SAMPLE_INITIAL per second, then one in LOG_SAMPLE_THEREAFTER
+    LOG_SAMPLE_INITIAL = int(os.getenv("LOG_SAMPLE_INITIAL", "10"))
+    LOG_SAMPLE_THEREAFTER = int(os.getenv("LOG_SAMPLE_THEREAFTER", "1000"))
     
     # Agent configuration
     ROUTER_MODEL = "gpt-3.5-turbo"
     KNOWLEDGE_MODEL = "gpt-3.5-turbo"
     MATH_MODEL = "gpt-3.5-turbo"
+    LLM_BATCH_MAX_SIZE = int(os.getenv("LLM_BATCH_MAX_SIZE", "8"))
+    LLM_BATCH_MAX_WAIT_MS = int(os.getenv("LLM_BATCH_MAX_WAIT_MS", "10"))
+    # Batches (and per-prompt fallbacks) in flight at once
+    LLM_BATCH_MAX_WORKERS = int(os.getenv("LLM_BATCH_MAX_WORKERS", "16"))
     
     # API configuration
     API_HOST = os.getenv("API_HOST", "0.0.0.0")
     API_PORT = int(os.getenv("API_PORT", "8000"))
     API_DEBUG = os.getenv("API_DEBUG", "false").lower() == "true"
+    API_WORKERS = int(os.getenv("API_WORKERS", str(max(2, (os.cpu_count() or 1) // 2))))
+    # Rate limit tokens each worker takes from the shared Redis bucket per round trip (1 = exact limit)
+    RATE_LIMIT_LEASE_SIZE = int(os.getenv("RATE_LIMIT_LEASE_SIZE", "5"))
+    # Client IPs each worker tracks per minute window; the least recently seen are dropped beyond this
+    RATE_LIMIT_MAX_TRACKED = int(os.getenv("RATE_LIMIT_MAX_TRACKED", "100000"))
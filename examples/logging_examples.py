@@ -71,7 +71,7 @@ error_log = {
     "error": "Vector store connection failed: Connection timeout",
     "metadata": {
         "error_type": "knowledge_query_failure",
-        "error_id": "ERR_1704634340123",
+        "error_id": "ERR_1704634340123_42",
         "retry_attempt": 1,
         "fallback_used": True
     }
@@ -1,10 +1,12 @@
 """Main application entry point for the modular chatbot."""
 import os
+from contextlib import asynccontextmanager
 from datetime import datetime
 from typing import Optional, List
 from fastapi import FastAPI, HTTPException, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from models import ChatRequest, ChatResponse, ChatMessage
 from services.conversation_service import ConversationService
@@ -14,11 +16,28 @@ from utils.error_handler import error_handler
 from middleware.security_middleware import SecurityMiddleware, InputValidationMiddleware
 from config import Config
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Check the Redis connection on startup and close its pool on shutdown."""
+    if await redis_service.health_check():
+        logger.log_info("Redis connection established successfully")
+        # Conversations saved in the old layout are not in any user's conversation set yet
+        indexed = await redis_service.index_legacy_conversations()
+        if indexed:
+            logger.log_info("Indexed legacy conversations", metadata={"count": indexed})
+    else:
+        logger.log_error(None, "Redis connection failed")
+    
+    yield
+    
+    await redis_service.redis_client.aclose()
+
 # Initialize FastAPI app
 app = FastAPI(
     title="Modular Chatbot with Router",
     description="A modular chatbot that routes messages to specialized agents",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Add security middleware
@@ -45,6 +64,10 @@ redis_service = RedisService()
 def get_redis_service() -> RedisService:
     return redis_service
 
+# Dependency for the chat and conversation routes
+def get_conversation_service() -> ConversationService:
+    return conversation_service
+
 # Error handlers
 @app.exception_handler(StarletteHTTPException)
 async def http_exception_handler(request: Request, exc: StarletteHTTPException):
@@ -75,7 +98,7 @@ async def root():
 @app.get("/health")
 async def health_check(redis: RedisService = Depends(get_redis_service)):
     """Health check endpoint."""
-    redis_healthy = redis.health_check()
+    redis_healthy = await redis.health_check()
     
     return {
         "status": "healthy" if redis_healthy else "degraded",
@@ -86,21 +109,38 @@ async def health_check(redis: RedisService = Depends(get_redis_service)):
         }
     }
 
-@app.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
+@app.post(
+    "/chat",
+    response_model=ChatResponse,
+    openapi_extra={"requestBody": {"content": {"application/json": {"schema": ChatRequest.model_json_schema()}}, "required": True}}
+)
+async def chat(request: Request, service: ConversationService = Depends(get_conversation_service)):
     """Main chat endpoint that routes messages to appropriate agents."""
+    # InputValidationMiddleware already parsed and sanitized the body
+    payload = getattr(request.state, "chat_payload", None)
+    if payload is None:
+        try:
+            payload = await request.json()
+        except ValueError:
+            raise RequestValidationError([{"loc": ("body",), "msg": "Invalid JSON", "type": "value_error.jsondecode"}])
+    
+    try:
+        chat_request = ChatRequest.model_validate(payload)
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+    
     try:
-        return conversation_service.process_message(request)
+        return await service.process_message(chat_request)
     except Exception as e:
         # Error handling is now managed by the global exception handler
         # This ensures no raw exceptions are exposed to clients
         raise
 
 @app.get("/conversations/{conversation_id}")
-async def get_conversation(conversation_id: str):
+async def get_conversation(conversation_id: str, service: ConversationService = Depends(get_conversation_service)):
     """Get conversation history by ID."""
     try:
-        messages = conversation_service.get_conversation_history(conversation_id)
+        messages = await service.get_conversation_history(conversation_id)
         if messages is None:
             raise HTTPException(status_code=404, detail="Conversation not found")
         
@@ -116,10 +156,10 @@ async def get_conversation(conversation_id: str):
         raise
 
 @app.get("/conversations/user/{user_id}")
-async def get_user_conversations(user_id: str):
+async def get_user_conversations(user_id: str, service: ConversationService = Depends(get_conversation_service)):
     """Get all conversations for a user."""
     try:
-        conversation_ids = conversation_service.get_user_conversations(user_id)
+        conversation_ids = await service.get_user_conversations(user_id)
         return {
             "user_id": user_id,
             "conversation_ids": conversation_ids,
@@ -130,6 +170,7 @@ async def get_user_conversations(user_id: str):
         raise
 
 if __name__ == "__main__":
+    import importlib.util
     import uvicorn
     
     # Check if OpenAI API key is configured
@@ -139,10 +180,14 @@ if __name__ == "__main__":
     
     logger.log_info("Starting Modular Chatbot with Router API...")
     
+    # uvloop and httptools (uvicorn[standard]) are used when installed; reload needs a single process
     uvicorn.run(
         "main:app",
         host=Config.API_HOST,
         port=Config.API_PORT,
         reload=Config.API_DEBUG,
+        workers=None if Config.API_DEBUG else Config.API_WORKERS,
+        loop="uvloop" if importlib.util.find_spec("uvloop") else "asyncio",
+        http="httptools" if importlib.util.find_spec("httptools") else "h11",
         log_level="info"
     )
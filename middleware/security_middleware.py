@@ -1,21 +1,66 @@
 """Security middleware for FastAPI application."""
+import json
 import time
-from typing import Dict, Any
+from collections import OrderedDict
+from typing import Any
 from fastapi import Request, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from starlette.middleware.base import BaseHTTPMiddleware
-from utils.security import SecurityValidator
+from redis.exceptions import RedisError
+from services.redis_service import RedisService
+from config import Config
+from utils.security import get_security_validator, get_client_ip, SAFE_ERROR_MESSAGES
 from utils.logger import StructuredLogger
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+# Security headers added to every response, pre-encoded as raw ASGI header pairs
+_SECURITY_HEADERS = (
+    (b"x-content-type-options", b"nosniff"),
+    (b"x-frame-options", b"DENY"),
+    (b"x-xss-protection", b"1; mode=block"),
+    (b"strict-transport-security", b"max-age=31536000; includeSubDomains"),
+    (b"referrer-policy", b"strict-origin-when-cross-origin"),
+)
+
+# Rate limit rejections are the hot path under abuse, so their body is encoded once
+# (with JSONResponse's own settings, so the bytes are unchanged)
+_RATE_LIMIT_BODY = json.dumps(
+    {"error": "Rate limit exceeded", "message": SAFE_ERROR_MESSAGES["rate_limit"]},
+    ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+).encode("utf-8")
+
+def _loads(body: bytes) -> Any:
+    """Parse a JSON request body straight from bytes."""
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
 class SecurityMiddleware(BaseHTTPMiddleware):
     """Security middleware for input validation and rate limiting."""
     
     def __init__(self, app, rate_limit_per_minute: int = 60):
         super().__init__(app)
-        self.security_validator = SecurityValidator()
+        self.security_validator = get_security_validator()
         self.logger = StructuredLogger("SecurityMiddleware")
         self.rate_limit_per_minute = rate_limit_per_minute
-        self.request_counts: Dict[str, Dict[str, Any]] = {}
+        # Buckets live in Redis so every worker enforces the same limit; each worker
+        # takes tokens in leases so a busy client costs one round trip per lease
+        self.redis_service = RedisService()
+        self.lease_size = max(1, min(Config.RATE_LIMIT_LEASE_SIZE, rate_limit_per_minute))
+        
+        # Per-minute state, swapped at rollover instead of scanned: leased tokens not yet used,
+        # and the request counts of the per-process fallback used while Redis is unreachable.
+        # Each window tracks at most max_tracked IPs, dropping the least recently seen.
+        self.max_tracked = Config.RATE_LIMIT_MAX_TRACKED
+        self._window = int(time.time() // 60)
+        self._current_leases: "OrderedDict[str, int]" = OrderedDict()
+        self._previous_leases: "OrderedDict[str, int]" = OrderedDict()
+        self._current_counts: "OrderedDict[str, int]" = OrderedDict()
+        self._previous_counts: "OrderedDict[str, int]" = OrderedDict()
     
     async def dispatch(self, request: Request, call_next):
         """Process request through security checks."""
@@ -23,27 +68,19 @@ class SecurityMiddleware(BaseHTTPMiddleware):
         
         try:
             # Get client IP
-            client_ip = self._get_client_ip(request)
+            client_ip = get_client_ip(request)
             
             # Rate limiting check
-            if not self._check_rate_limit(client_ip):
-                return JSONResponse(
-                    status_code=429,
-                    content={
-                        "error": "Rate limit exceeded",
-                        "message": self.security_validator.get_safe_error_message("rate_limit")
-                    }
-                )
+            if not await self._check_rate_limit(client_ip, start_time):
+                response = Response(_RATE_LIMIT_BODY, status_code=429, media_type="application/json")
+                response.raw_headers.extend(_SECURITY_HEADERS)
+                return response
             
             # Security headers
             response = await call_next(request)
             
             # Add security headers
-            response.headers["X-Content-Type-Options"] = "nosniff"
-            response.headers["X-Frame-Options"] = "DENY"
-            response.headers["X-XSS-Protection"] = "1; mode=block"
-            response.headers["Strict-Transport-Security"] = "max-age=31536000; includeSubDomains"
-            response.headers["Referrer-Policy"] = "strict-origin-when-cross-origin"
+            response.raw_headers.extend(_SECURITY_HEADERS)
             
             # Log request
             processing_time = time.time() - start_time
@@ -75,59 +112,70 @@ class SecurityMiddleware(BaseHTTPMiddleware):
                 }
             )
     
-    def _get_client_ip(self, request: Request) -> str:
-        """Get client IP address."""
-        # Check for forwarded headers first
-        forwarded_for = request.headers.get("X-Forwarded-For")
-        if forwarded_for:
-            return forwarded_for.split(",")[0].strip()
+    def _rotate_windows(self, now: float):
+        """Start a new minute window, keeping only the previous one."""
+        window = int(now // 60)
+        if window == self._window:
+            return
         
-        real_ip = request.headers.get("X-Real-IP")
-        if real_ip:
-            return real_ip
-        
-        # Fallback to direct connection
-        return request.client.host if request.client else "unknown"
+        adjacent = window == self._window + 1
+        self._previous_leases = self._current_leases if adjacent else OrderedDict()
+        self._previous_counts = self._current_counts if adjacent else OrderedDict()
+        self._current_leases = OrderedDict()
+        self._current_counts = OrderedDict()
+        self._window = window
     
-    def _check_rate_limit(self, client_ip: str) -> bool:
-        """Check if client is within rate limit."""
-        current_time = time.time()
-        minute_window = int(current_time // 60)
-        
-        # Clean old entries
-        self.request_counts = {
-            ip: data for ip, data in self.request_counts.items()
-            if data.get("minute_window", 0) >= minute_window - 1
-        }
-        
-        # Get or create client data
-        if client_ip not in self.request_counts:
-            self.request_counts[client_ip] = {
-                "count": 0,
-                "minute_window": minute_window
-            }
+    def _track(self, table: "OrderedDict[str, int]", client_ip: str, value: int):
+        """Store a per-IP value as most recently seen, evicting the oldest IP past max_tracked."""
+        table[client_ip] = value
+        table.move_to_end(client_ip)
+        if len(table) > self.max_tracked:
+            table.popitem(last=False)
+    
+    async def _check_rate_limit(self, client_ip: str, now: float) -> bool:
+        """Check if client is within rate limit at the given wall-clock time."""
+        self._rotate_windows(now)
         
-        client_data = self.request_counts[client_ip]
+        # Serve from this worker's lease; leases unused for two windows are dropped
+        lease = self._current_leases.pop(client_ip, 0) or self._previous_leases.pop(client_ip, 0)
+        if lease:
+            if lease > 1:
+                self._track(self._current_leases, client_ip, lease - 1)
+            return True
         
-        # Reset count if new minute
-        if client_data["minute_window"] != minute_window:
-            client_data["count"] = 0
-            client_data["minute_window"] = minute_window
+        try:
+            granted = await self.redis_service.take_rate_limit_tokens(
+                f"rl:{client_ip}",
+                self.rate_limit_per_minute,
+                self.rate_limit_per_minute / 60,
+                self.lease_size,
+                now=now
+            )
+            if granted > 1:
+                self._track(self._current_leases, client_ip, granted - 1)
+            allowed = granted > 0
+        except RedisError as e:
+            self.logger.log_error(None, f"Rate limit check failed: {str(e)}", metadata={"client_ip": client_ip})
+            allowed = self._check_local_rate_limit(client_ip)
         
-        # Check rate limit
-        if client_data["count"] >= self.rate_limit_per_minute:
+        if not allowed:
             self.logger.log_info(
                 "Rate limit exceeded",
                 metadata={
                     "client_ip": client_ip,
-                    "count": client_data["count"],
                     "limit": self.rate_limit_per_minute
                 }
             )
+        
+        return allowed
+    
+    def _check_local_rate_limit(self, client_ip: str) -> bool:
+        """Count the request against this process's last two one-minute windows."""
+        count = self._current_counts.get(client_ip, 0)
+        if count + self._previous_counts.get(client_ip, 0) >= self.rate_limit_per_minute:
             return False
         
-        # Increment count
-        client_data["count"] += 1
+        self._track(self._current_counts, client_ip, count + 1)
         return True
 
 class InputValidationMiddleware(BaseHTTPMiddleware):
@@ -135,7 +183,7 @@ class InputValidationMiddleware(BaseHTTPMiddleware):
     
     def __init__(self, app):
         super().__init__(app)
-        self.security_validator = SecurityValidator()
+        self.security_validator = get_security_validator()
         self.logger = StructuredLogger("InputValidationMiddleware")
     
     async def dispatch(self, request: Request, call_next):
@@ -148,9 +196,8 @@ class InputValidationMiddleware(BaseHTTPMiddleware):
                 
                 if body:
                     # Parse JSON
-                    import json
                     try:
-                        data = json.loads(body.decode())
+                        data = _loads(body)
                         
                         # Validate and sanitize message
                         if "message" in data:
@@ -162,7 +209,7 @@ class InputValidationMiddleware(BaseHTTPMiddleware):
                                 self.logger.log_info(
                                     "Prompt injection attempt blocked",
                                     metadata={
-                                        "client_ip": self._get_client_ip(request),
+                                        "client_ip": get_client_ip(request),
                                         "confidence": injection_check["confidence"],
                                         "patterns": injection_check["patterns_found"]
                                     }
@@ -210,15 +257,10 @@ class InputValidationMiddleware(BaseHTTPMiddleware):
                                     }
                                 )
                             
-                            # Create new request with sanitized data
-                            new_body = json.dumps(data).encode()
-                            
-                            # Replace request body
-                            async def receive():
-                                return {"type": "http.request", "body": new_body}
-                            
-                            request._receive = receive
+                        # Hand the parsed (and sanitized) payload to the route instead of re-encoding the body
+                        request.state.chat_payload = data
                     
+                    # Also catches orjson.JSONDecodeError, which subclasses it
                     except json.JSONDecodeError:
                         return JSONResponse(
                             status_code=400,
@@ -236,7 +278,7 @@ class InputValidationMiddleware(BaseHTTPMiddleware):
             self.logger.log_error(
                 None,
                 f"Input validation error: {str(e)}",
-                metadata={"client_ip": self._get_client_ip(request)}
+                metadata={"client_ip": get_client_ip(request)}
             )
             
             return JSONResponse(
@@ -246,15 +288,3 @@ class InputValidationMiddleware(BaseHTTPMiddleware):
                     "message": self.security_validator.get_safe_error_message("general")
                 }
             )
-    
-    def _get_client_ip(self, request: Request) -> str:
-        """Get client IP address."""
-        forwarded_for = request.headers.get("X-Forwarded-For")
-        if forwarded_for:
-            return forwarded_for.split(",")[0].strip()
-        
-        real_ip = request.headers.get("X-Real-IP")
-        if real_ip:
-            return real_ip
-        
-        return request.client.host if request.client else "unknown"
@@ -1,83 +1,61 @@
 #!/usr/bin/env python3
 """Test runner script for the modular chatbot."""
-import subprocess
 import sys
 import os
 
+# Set environment variables for testing before any application module is imported
+os.environ.setdefault("OPENAI_API_KEY", "test_key")
+os.environ.setdefault("REDIS_HOST", "localhost")
+os.environ.setdefault("REDIS_PORT", "6379")
+os.environ.setdefault("API_DEBUG", "true")
+
+try:
+    import pytest
+except ImportError:
+    pytest = None
+
+UNIT_TESTS = ["tests/test_router_agent.py", "tests/test_math_agent.py"]
+E2E_TESTS = ["tests/test_e2e_chat_api.py"]
+
+def _run_pytest(paths, label, extra_args=None):
+    """Run pytest in-process on the given paths and report the outcome."""
+    if pytest is None:
+        print("❌ pytest not found. Please install it with: pip install pytest")
+        return 1
+    
+    args = [*paths, "-v", "--tb=short", "--color=yes", *(extra_args or [])]
+    
+    # Keep pytest's cache locally (for --lf/--ff); on CI skip writing it and also run the slow tests
+    if os.getenv("CI"):
+        args += ["-p", "no:cacheprovider", "-m", "slow or not slow"]
+    
+    exit_code = int(pytest.main(args))
+    if exit_code == 0:
+        print(f"\n✅ {label} passed!")
+    else:
+        print(f"\n❌ {label} failed with exit code {exit_code}")
+    return exit_code
+
 def run_tests():
     """Run all tests with proper configuration."""
     print("🧪 Running Modular Chatbot Tests")
     print("=" * 50)
     
-    # Set environment variables for testing
-    os.environ["OPENAI_API_KEY"] = "test_key"
-    os.environ["REDIS_HOST"] = "localhost"
-    os.environ["REDIS_PORT"] = "6379"
-    os.environ["API_DEBUG"] = "true"
-    
-    # Run pytest with specific options
-    cmd = [
-        "python", "-m", "pytest",
-        "tests/",
-        "-v",
-        "--tb=short",
-        "--color=yes",
-        "--durations=10"
-    ]
-    
-    try:
-        result = subprocess.run(cmd, check=True)
-        print("\n✅ All tests passed!")
-        return 0
-    except subprocess.CalledProcessError as e:
-        print(f"\n❌ Tests failed with exit code {e.returncode}")
-        return e.returncode
-    except FileNotFoundError:
-        print("❌ pytest not found. Please install it with: pip install pytest")
-        return 1
+    return _run_pytest(["tests/"], "All tests", ["--durations=10"])
 
 def run_unit_tests():
     """Run only unit tests."""
     print("🧪 Running Unit Tests")
     print("=" * 30)
     
-    cmd = [
-        "python", "-m", "pytest",
-        "tests/test_router_agent.py",
-        "tests/test_math_agent.py",
-        "-v",
-        "--tb=short",
-        "--color=yes"
-    ]
-    
-    try:
-        subprocess.run(cmd, check=True)
-        print("\n✅ Unit tests passed!")
-        return 0
-    except subprocess.CalledProcessError as e:
-        print(f"\n❌ Unit tests failed with exit code {e.returncode}")
-        return e.returncode
+    return _run_pytest(UNIT_TESTS, "Unit tests")
 
 def run_e2e_tests():
     """Run only E2E tests."""
     print("🧪 Running E2E Tests")
     print("=" * 30)
     
-    cmd = [
-        "python", "-m", "pytest",
-        "tests/test_e2e_chat_api.py",
-        "-v",
-        "--tb=short",
-        "--color=yes"
-    ]
-    
-    try:
-        subprocess.run(cmd, check=True)
-        print("\n✅ E2E tests passed!")
-        return 0
-    except subprocess.CalledProcessError as e:
-        print(f"\n❌ E2E tests failed with exit code {e.returncode}")
-        return e.returncode
+    return _run_pytest(E2E_TESTS, "E2E tests")
 
 if __name__ == "__main__":
     if len(sys.argv) > 1:
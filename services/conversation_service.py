@@ -1,4 +1,5 @@
 """Conversation service for managing chat workflows."""
+import re
 import time
 from datetime import datetime
 from typing import Optional, List
@@ -16,14 +17,20 @@ from utils.error_handler import error_handler
 class ConversationService:
     """Service for managing conversation workflows and agent coordination."""
     
-    def __init__(self):
-        self.redis_service = RedisService()
-        self.router_agent = RouterAgent()
-        self.knowledge_agent = KnowledgeAgent()
-        self.math_agent = MathAgent()
+    # Math answers that already introduce their result skip the enthusiastic prefix
+    _MATH_ANSWER_RE = re.compile(r"resultado|resposta", re.IGNORECASE)
+    
+    def __init__(self, redis_service: Optional[RedisService] = None,
+                 router_agent: Optional[RouterAgent] = None,
+                 knowledge_agent: Optional[KnowledgeAgent] = None,
+                 math_agent: Optional[MathAgent] = None):
+        self.redis_service = redis_service or RedisService()
+        self.router_agent = router_agent or RouterAgent()
+        self.knowledge_agent = knowledge_agent or KnowledgeAgent()
+        self.math_agent = math_agent or MathAgent()
         self.logger = StructuredLogger("ConversationService")
     
-    def process_message(self, request: ChatRequest) -> ChatResponse:
+    async def process_message(self, request: ChatRequest) -> ChatResponse:
         """Process a chat message through the complete workflow."""
         start_time = time.time()
         workflow_steps = []
@@ -41,11 +48,11 @@ class ConversationService:
             )
             
             # Save user message to conversation history
-            self.redis_service.save_message(conversation_id, chat_message)
+            await self.redis_service.save_message(conversation_id, chat_message)
             
             # Step 1: Router Agent Decision
             router_start = time.time()
-            decision = self.router_agent.route_message(chat_message)
+            decision = await self.router_agent.aroute_message(chat_message)
             router_time = time.time() - router_start
             
             workflow_steps.append(AgentWorkflowStep(
@@ -63,7 +70,7 @@ class ConversationService:
             source_response = ""
             
             if decision.agent_type == AgentType.KNOWLEDGE:
-                response = self.knowledge_agent.answer_question(chat_message)
+                response = await self.knowledge_agent.aanswer_question(chat_message)
                 source_response = response.answer
                 
                 workflow_steps.append(AgentWorkflowStep(
@@ -76,7 +83,7 @@ class ConversationService:
                 ))
                 
             elif decision.agent_type == AgentType.MATH:
-                response = self.math_agent.solve_math_problem(chat_message)
+                response = await self.math_agent.asolve_math_problem(chat_message)
                 source_response = response.answer
                 
                 workflow_steps.append(AgentWorkflowStep(
@@ -105,7 +112,7 @@ class ConversationService:
             )
             
             # Save response to conversation history
-            self.redis_service.save_message(conversation_id, response_message)
+            await self.redis_service.save_message(conversation_id, response_message)
             
             # Create final response
             chat_response = ChatResponse(
@@ -157,29 +164,29 @@ class ConversationService:
         """Add personality to the agent response."""
         if agent_type == AgentType.KNOWLEDGE:
             # Add friendly, helpful personality for knowledge responses
-            if not response.startswith("Olá") and not response.startswith("Oi"):
+            if not response.startswith(("Olá", "Oi")):
                 response = f"Olá! {response.lower()}"
             
             # Add helpful closing
-            if not response.endswith(".") and not response.endswith("!"):
+            if not response.endswith((".", "!")):
                 response += "."
             
             response += " Se precisar de mais alguma coisa, estou aqui para ajudar! 😊"
             
         elif agent_type == AgentType.MATH:
             # Add enthusiastic personality for math responses
-            if "resultado" not in response.lower() and "resposta" not in response.lower():
+            if self._MATH_ANSWER_RE.search(response) is None:
                 response = f"Perfeito! Aqui está a solução:\n\n{response}"
             
             response += "\n\nMatemática é incrível, não é? 🧮✨"
         
         return response
     
-    def get_conversation_history(self, conversation_id: str) -> Optional[List[ChatMessage]]:
+    async def get_conversation_history(self, conversation_id: str) -> Optional[List[ChatMessage]]:
         """Get conversation history."""
-        conversation = self.redis_service.get_conversation_history(conversation_id)
+        conversation = await self.redis_service.get_conversation_history(conversation_id)
         return conversation.messages if conversation else None
     
-    def get_user_conversations(self, user_id: str) -> List[str]:
+    async def get_user_conversations(self, user_id: str) -> List[str]:
         """Get all conversation IDs for a user."""
-        return self.redis_service.get_user_conversations(user_id)
+        return await self.redis_service.get_user_conversations(user_id)
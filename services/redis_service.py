@@ -1,81 +1,103 @@
 """Redis service for conversation management and logging."""
 import json
-import uuid
+import secrets
+import time
 from datetime import datetime
 from typing import Optional, List, Dict, Any
-import redis
-from redis.exceptions import RedisError
+from redis import asyncio as aioredis
+from pydantic import TypeAdapter
+from redis.exceptions import WatchError
 from models import ChatMessage, ConversationHistory, AgentLog
 from config import Config
 from utils.logger import StructuredLogger
 
+# Token bucket per key: refills continuously at ARGV[2] tokens/ms up to ARGV[1] and hands out
+# up to ARGV[4] whole tokens, returning how many were taken. Idle buckets expire once they would be full again.
+RATE_LIMIT_LUA = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local requested = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'last_refill')
+local tokens = tonumber(bucket[1]) or capacity
+local last_refill = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - last_refill) * rate)
+local granted = math.min(requested, math.floor(tokens))
+tokens = tokens - granted
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'last_refill', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate))
+return granted
+"""
+
+# Validates a whole stored message list in one pydantic-core call
+_MESSAGE_LIST = TypeAdapter(List[ChatMessage])
+
+# Conversations used to be one JSON blob in the "data" field of this hash
+_LEGACY_CONVERSATION_KEY = "conversation:{}"
+
+# Serialize straight to the bytes Redis stores
+_dump_message = TypeAdapter(ChatMessage).dump_json
+_dump_agent_log = TypeAdapter(AgentLog).dump_json
+
 class RedisService:
     """Redis service for managing conversations and logs."""
     
     def __init__(self):
         self.logger = StructuredLogger("RedisService")
         self.redis_client = self._create_redis_client()
+        self.rate_limit_script = self.redis_client.register_script(RATE_LIMIT_LUA)
     
-    def _create_redis_client(self) -> redis.Redis:
+    def _create_redis_client(self) -> aioredis.Redis:
         """Create Redis client with proper configuration."""
-        try:
-            client = redis.Redis(
-                host=Config.REDIS_HOST,
-                port=Config.REDIS_PORT,
-                db=Config.REDIS_DB,
-                password=Config.REDIS_PASSWORD,
-                decode_responses=True,
-                socket_connect_timeout=5,
-                socket_timeout=5,
-                retry_on_timeout=True
-            )
-            
-            # Test connection
-            client.ping()
-            self.logger.log_info("Redis connection established successfully")
-            return client
-            
-        except RedisError as e:
-            self.logger.log_error(None, f"Redis connection failed: {str(e)}")
-            raise
+        # Connections are opened lazily on the event loop; call health_check to verify them
+        return aioredis.Redis(
+            host=Config.REDIS_HOST,
+            port=Config.REDIS_PORT,
+            db=Config.REDIS_DB,
+            password=Config.REDIS_PASSWORD,
+            decode_responses=True,
+            socket_connect_timeout=5,
+            socket_timeout=5,
+            retry_on_timeout=True
+        )
+    
+    async def take_rate_limit_tokens(self, key: str, capacity: int, refill_per_second: float,
+                                     count: int = 1, now: Optional[float] = None) -> int:
+        """Take up to count tokens from the bucket at key in a single round trip; returns how many were taken."""
+        now_ms = int((now if now is not None else time.time()) * 1000)
+        return int(await self.rate_limit_script(keys=[key], args=[capacity, refill_per_second / 1000, now_ms, count]))
     
     def generate_conversation_id(self) -> str:
         """Generate a unique conversation ID."""
-        return f"conv-{uuid.uuid4().hex[:8]}"
+        return f"conv-{secrets.token_hex(4)}"
     
-    def save_message(self, conversation_id: str, message: ChatMessage) -> bool:
+    async def save_message(self, conversation_id: str, message: ChatMessage) -> bool:
         """Save a message to conversation history."""
         try:
-            key = f"conversation:{conversation_id}"
-            
-            # Get existing conversation or create new one
-            conversation_data = self.redis_client.hget(key, "data")
-            if conversation_data:
-                conversation = ConversationHistory.parse_raw(conversation_data)
-            else:
-                conversation = ConversationHistory(
-                    conversation_id=conversation_id,
-                    user_id=message.user_id or "anonymous",
-                    messages=[],
-                    created_at=datetime.now(),
-                    updated_at=datetime.now()
-                )
-            
-            # Add new message
-            conversation.messages.append(message)
-            conversation.updated_at = datetime.now()
-            
-            # Save back to Redis
-            self.redis_client.hset(
-                key,
-                mapping={
-                    "data": conversation.json(),
-                    "updated_at": conversation.updated_at.isoformat()
-                }
-            )
-            
-            # Set expiration (30 days)
-            self.redis_client.expire(key, 30 * 24 * 60 * 60)
+            user_id = message.user_id or "anonymous"
+            meta_key = f"conversation:{conversation_id}:meta"
+            messages_key = f"conversation:{conversation_id}:messages"
+            user_key = f"user:{user_id}:conversations"
+            now = datetime.now().isoformat()
+            
+            # Append the message and update the metadata and the user's index in one round trip;
+            # the first message sets the owner and creation time
+            async with self.redis_client.pipeline(transaction=False) as pipeline:
+                pipeline.hsetnx(meta_key, "user_id", user_id)
+                pipeline.hsetnx(meta_key, "created_at", now)
+                pipeline.hset(meta_key, "updated_at", now)
+                pipeline.rpush(messages_key, _dump_message(message))
+                pipeline.sadd(user_key, conversation_id)
+                
+                # Set expiration (30 days)
+                pipeline.expire(meta_key, 30 * 24 * 60 * 60)
+                pipeline.expire(messages_key, 30 * 24 * 60 * 60)
+                pipeline.expire(user_key, 30 * 24 * 60 * 60)
+                created, *_ = await pipeline.execute()
+            
+            # A new metadata hash may belong to a conversation still stored in the old layout
+            if created:
+                await self._migrate_legacy_conversation(conversation_id)
             
             return True
             
@@ -83,54 +105,115 @@ class RedisService:
             self.logger.log_error(None, f"Failed to save message: {str(e)}")
             return False
     
-    def get_conversation_history(self, conversation_id: str) -> Optional[ConversationHistory]:
-        """Get conversation history by ID."""
+    async def _migrate_legacy_conversation(self, conversation_id: str):
+        """Move a conversation stored in the old layout into the list layout, ahead of newer messages."""
+        legacy_key = _LEGACY_CONVERSATION_KEY.format(conversation_id)
+        try:
+            async with self.redis_client.pipeline(transaction=True) as pipeline:
+                # Concurrent saves race to migrate; the watch lets only the first one commit
+                await pipeline.watch(legacy_key)
+                legacy_data = await pipeline.hget(legacy_key, "data")
+                if not legacy_data:
+                    return
+                
+                conversation = ConversationHistory.model_validate_json(legacy_data)
+                pipeline.multi()
+                pipeline.hset(f"conversation:{conversation_id}:meta", mapping={
+                    "user_id": conversation.user_id,
+                    "created_at": conversation.created_at.isoformat()
+                })
+                if conversation.messages:
+                    # LPUSH prepends one value at a time, so the oldest message goes last
+                    pipeline.lpush(
+                        f"conversation:{conversation_id}:messages",
+                        *[_dump_message(message) for message in reversed(conversation.messages)]
+                    )
+                pipeline.sadd(f"user:{conversation.user_id}:conversations", conversation_id)
+                pipeline.expire(f"user:{conversation.user_id}:conversations", 30 * 24 * 60 * 60)
+                pipeline.delete(legacy_key)
+                await pipeline.execute()
+            
+        except WatchError:
+            pass
+        except Exception as e:
+            self.logger.log_error(None, f"Failed to migrate legacy conversation: {str(e)}")
+    
+    async def index_legacy_conversations(self) -> int:
+        """Add conversations stored in the old layout to their owners' conversation sets.
+        
+        The old layout had no per-user index, so this lets get_user_conversations list them
+        until they are migrated by their next message or expire. Returns how many were indexed.
+        """
+        indexed = 0
         try:
-            key = f"conversation:{conversation_id}"
-            conversation_data = self.redis_client.hget(key, "data")
+            async for key in self.redis_client.scan_iter(match=_LEGACY_CONVERSATION_KEY.format("*"), count=1000):
+                if key.endswith((":meta", ":messages")):
+                    continue
+                
+                legacy_data = await self.redis_client.hget(key, "data")
+                if not legacy_data:
+                    continue
+                
+                conversation = ConversationHistory.model_validate_json(legacy_data)
+                await self.redis_client.sadd(f"user:{conversation.user_id}:conversations", conversation.conversation_id)
+                indexed += 1
             
-            if conversation_data:
-                return ConversationHistory.parse_raw(conversation_data)
-            return None
+        except Exception as e:
+            self.logger.log_error(None, f"Failed to index legacy conversations: {str(e)}")
+        
+        return indexed
+    
+    async def get_conversation_history(self, conversation_id: str) -> Optional[ConversationHistory]:
+        """Get conversation history by ID."""
+        try:
+            async with self.redis_client.pipeline(transaction=False) as pipeline:
+                pipeline.hgetall(f"conversation:{conversation_id}:meta")
+                pipeline.lrange(f"conversation:{conversation_id}:messages", 0, -1)
+                pipeline.hget(_LEGACY_CONVERSATION_KEY.format(conversation_id), "data")
+                meta, messages, legacy_data = await pipeline.execute()
+            
+            if not meta:
+                # Not migrated yet: saved before messages moved to a list
+                return ConversationHistory.model_validate_json(legacy_data) if legacy_data else None
+            
+            return ConversationHistory(
+                conversation_id=conversation_id,
+                user_id=meta["user_id"],
+                messages=_MESSAGE_LIST.validate_json(f"[{','.join(messages)}]"),
+                created_at=meta["created_at"],
+                updated_at=meta["updated_at"]
+            )
             
         except Exception as e:
             self.logger.log_error(None, f"Failed to get conversation history: {str(e)}")
             return None
     
-    def get_user_conversations(self, user_id: str) -> List[str]:
+    async def get_user_conversations(self, user_id: str) -> List[str]:
         """Get all conversation IDs for a user."""
         try:
-            pattern = f"conversation:*"
-            keys = self.redis_client.keys(pattern)
-            conversation_ids = []
-            
-            for key in keys:
-                conversation_data = self.redis_client.hget(key, "data")
-                if conversation_data:
-                    conversation = ConversationHistory.parse_raw(conversation_data)
-                    if conversation.user_id == user_id:
-                        conversation_ids.append(conversation.conversation_id)
-            
-            return conversation_ids
+            return list(await self.redis_client.smembers(f"user:{user_id}:conversations"))
             
         except Exception as e:
             self.logger.log_error(None, f"Failed to get user conversations: {str(e)}")
             return []
     
-    def save_agent_log(self, log: AgentLog) -> bool:
+    async def save_agent_log(self, log: AgentLog) -> bool:
         """Save agent log to Redis."""
         try:
             key = f"logs:{log.agent_type.value}:{datetime.now().strftime('%Y-%m-%d')}"
-            log_data = log.json()
-            
-            # Add to list with timestamp
-            self.redis_client.lpush(key, log_data)
-            
-            # Keep only last 1000 logs per agent per day
-            self.redis_client.ltrim(key, 0, 999)
-            
-            # Set expiration (7 days)
-            self.redis_client.expire(key, 7 * 24 * 60 * 60)
+            log_data = _dump_agent_log(log)
+            
+            # Push, trim and expire in a single round trip
+            async with self.redis_client.pipeline(transaction=False) as pipeline:
+                # Add to list with timestamp
+                pipeline.lpush(key, log_data)
+                
+                # Keep only last 1000 logs per agent per day
+                pipeline.ltrim(key, 0, 999)
+                
+                # Set expiration (7 days)
+                pipeline.expire(key, 7 * 24 * 60 * 60)
+                await pipeline.execute()
             
             return True
             
@@ -138,19 +221,19 @@ class RedisService:
             self.logger.log_error(None, f"Failed to save agent log: {str(e)}")
             return False
     
-    def get_agent_logs(self, agent_type: str, date: Optional[str] = None) -> List[AgentLog]:
+    async def get_agent_logs(self, agent_type: str, date: Optional[str] = None) -> List[AgentLog]:
         """Get agent logs for a specific date."""
         try:
             if not date:
                 date = datetime.now().strftime('%Y-%m-%d')
             
             key = f"logs:{agent_type}:{date}"
-            logs_data = self.redis_client.lrange(key, 0, -1)
+            logs_data = await self.redis_client.lrange(key, 0, -1)
             
             logs = []
             for log_data in logs_data:
                 try:
-                    log = AgentLog.parse_raw(log_data)
+                    log = AgentLog.model_validate_json(log_data)
                     logs.append(log)
                 except Exception:
                     continue  # Skip invalid logs
@@ -161,10 +244,10 @@ class RedisService:
             self.logger.log_error(None, f"Failed to get agent logs: {str(e)}")
             return []
     
-    def health_check(self) -> bool:
+    async def health_check(self) -> bool:
         """Check Redis connection health."""
         try:
-            self.redis_client.ping()
+            await self.redis_client.ping()
             return True
         except Exception:
             return False
@@ -0,0 +1,43 @@
+"""Shared pytest fixtures."""
+import sys
+import pytest
+from datetime import datetime
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+# Fixed clock seen by tests and by the code under test
+FIXED_TS = datetime(2025, 1, 7, 14, 32, 12)
+
+# Modules that stamp records with datetime.now()
+_CLOCK_MODULES = ("main", "services.conversation_service", "services.redis_service")
+
+class _FrozenDatetime(datetime):
+    """datetime whose now() always returns FIXED_TS."""
+    
+    @classmethod
+    def now(cls, tz=None):
+        return FIXED_TS if tz is None else FIXED_TS.replace(tzinfo=tz)
+
+def chat_completion(content: str) -> SimpleNamespace:
+    """Minimal chat completion with a single choice, shaped like the OpenAI response."""
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+def _fake_client_class() -> MagicMock:
+    """Stand-in for an OpenAI client class; every instance gets its own mocked API."""
+    return MagicMock(side_effect=lambda *args, **kwargs: MagicMock())
+
+@pytest.fixture(scope="session", autouse=True)
+def fake_openai():
+    """Replace the agents' OpenAI clients once for the whole test session."""
+    with patch.multiple("agents.math_agent", OpenAI=_fake_client_class()), \
+         patch.multiple("agents.router_agent", OpenAI=_fake_client_class(), AsyncOpenAI=_fake_client_class()):
+        yield
+
+@pytest.fixture(autouse=True)
+def frozen_clock(monkeypatch):
+    """Freeze datetime.now() in the already imported modules under test."""
+    for name in _CLOCK_MODULES:
+        module = sys.modules.get(name)
+        if module is not None:
+            monkeypatch.setattr(module, "datetime", _FrozenDatetime)
+    return FIXED_TS
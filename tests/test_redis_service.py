@@ -0,0 +1,63 @@
+"""Tests for RedisService conversation storage."""
+import pytest
+from datetime import datetime
+from models import ChatMessage, ConversationHistory
+from services.redis_service import RedisService
+from tests.conftest import FIXED_TS
+
+fakeredis = pytest.importorskip("fakeredis")
+
+LEGACY_ID = "conv-legacy"
+LEGACY_CREATED = datetime(2024, 12, 20, 9, 0, 0)
+LEGACY_HISTORY = ConversationHistory(
+    conversation_id=LEGACY_ID,
+    user_id="legacy_user",
+    messages=[
+        ChatMessage(message="What is 2 + 2?", timestamp=LEGACY_CREATED, user_id="legacy_user", conversation_id=LEGACY_ID),
+        ChatMessage(message="2 + 2 = 4", timestamp=LEGACY_CREATED, user_id="legacy_user", conversation_id=LEGACY_ID),
+    ],
+    created_at=LEGACY_CREATED,
+    updated_at=LEGACY_CREATED
+)
+
+@pytest.fixture
+async def redis_service(monkeypatch):
+    """RedisService over an in-memory Redis holding one conversation in the old layout."""
+    monkeypatch.setattr(RedisService, "_create_redis_client", lambda self: fakeredis.FakeAsyncRedis(decode_responses=True))
+    service = RedisService()
+    await service.redis_client.hset(f"conversation:{LEGACY_ID}", mapping={
+        "data": LEGACY_HISTORY.model_dump_json(),
+        "updated_at": LEGACY_CREATED.isoformat()
+    })
+    yield service
+    await service.redis_client.aclose()
+
+class TestLegacyConversations:
+    """Conversations saved before messages moved to a Redis list."""
+    
+    async def test_history_falls_back_to_legacy_layout(self, redis_service):
+        """Test that an unmigrated conversation is still readable."""
+        history = await redis_service.get_conversation_history(LEGACY_ID)
+        
+        assert history == LEGACY_HISTORY
+    
+    async def test_save_message_migrates_legacy_conversation(self, redis_service):
+        """Test that the next message moves the old history ahead of it in the new layout."""
+        new_message = ChatMessage(message="And 3 + 3?", timestamp=FIXED_TS, user_id="legacy_user", conversation_id=LEGACY_ID)
+        
+        assert await redis_service.save_message(LEGACY_ID, new_message)
+        
+        history = await redis_service.get_conversation_history(LEGACY_ID)
+        assert history.messages == LEGACY_HISTORY.messages + [new_message]
+        assert history.user_id == "legacy_user"
+        assert history.created_at == LEGACY_CREATED
+        assert not await redis_service.redis_client.exists(f"conversation:{LEGACY_ID}")
+        assert await redis_service.get_user_conversations("legacy_user") == [LEGACY_ID]
+    
+    async def test_index_legacy_conversations(self, redis_service):
+        """Test that unmigrated conversations are listed for their owner after indexing."""
+        assert await redis_service.get_user_conversations("legacy_user") == []
+        
+        assert await redis_service.index_legacy_conversations() == 1
+        
+        assert await redis_service.get_user_conversations("legacy_user") == [LEGACY_ID]
@@ -0,0 +1,136 @@
+"""Request coalescing for LLM chat completions."""
+import json
+import time
+import queue
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional, Tuple
+from openai import OpenAI
+from utils.logger import StructuredLogger
+
+class LLMBatcher:
+    """DataLoader-style batcher that coalesces concurrent prompts into one chat completion.
+    
+    Prompts submitted within ``max_wait`` seconds of each other (up to ``max_batch``)
+    are sent as a single request asking the model to answer each one independently.
+    Batches run on a pool of ``max_workers`` threads, so collection never waits on a request.
+    Prompts from different users share a completion, so they must not carry user text.
+    """
+    
+    def __init__(self, client: OpenAI, model: str,
+                 max_batch: int = 8, max_wait: float = 0.01,
+                 temperature: float = 0.1, max_tokens: int = 300,
+                 max_workers: int = 16):
+        self.client = client
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.logger = StructuredLogger("LLMBatcher")
+        self._queue: "queue.Queue[Tuple[str, int, Future]]" = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+        self._worker_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="LLMBatcher")
+    
+    def submit(self, prompt: str, timeout: Optional[float] = None,
+               max_tokens: Optional[int] = None) -> str:
+        """Submit a prompt and block until its completion is available."""
+        return self._enqueue(prompt, max_tokens).result(timeout)
+    
+    async def asubmit(self, prompt: str, max_tokens: Optional[int] = None) -> str:
+        """Submit a prompt from async code without blocking the event loop."""
+        return await asyncio.wrap_future(self._enqueue(prompt, max_tokens))
+    
+    def _enqueue(self, prompt: str, max_tokens: Optional[int] = None) -> Future:
+        """Queue a prompt for the worker thread, starting it on first use."""
+        if self._worker is None:
+            with self._worker_lock:
+                if self._worker is None:
+                    self._worker = threading.Thread(target=self._run, name="LLMBatcher", daemon=True)
+                    self._worker.start()
+        
+        future: Future = Future()
+        self._queue.put((prompt, max_tokens or self.max_tokens, future))
+        return future
+    
+    def _run(self):
+        """Collect prompts into batches and dispatch them."""
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            # The collector goes straight back to gathering the next batch
+            self._executor.submit(self._dispatch, batch)
+    
+    def _dispatch(self, batch: List[Tuple[str, int, Future]]):
+        """Resolve every future in the batch with its completion or error."""
+        if len(batch) == 1:
+            self._resolve(*batch[0])
+            return
+        
+        prompts = [prompt for prompt, _, _ in batch]
+        token_limits = [max_tokens for _, max_tokens, _ in batch]
+        
+        try:
+            answers = self._complete_batch(prompts, token_limits)
+        except Exception as e:
+            # Answer each prompt on its own, concurrently rather than one after another
+            self.logger.log_error(None, f"Batched LLM completion failed, answering individually: {str(e)}")
+            for prompt, max_tokens, future in batch:
+                self._executor.submit(self._resolve, prompt, max_tokens, future)
+            return
+        
+        for (_, _, future), answer in zip(batch, answers):
+            future.set_result(answer)
+    
+    def _resolve(self, prompt: str, max_tokens: int, future: Future):
+        """Resolve a single prompt's future with its own completion or error."""
+        try:
+            future.set_result(self._complete(prompt, max_tokens))
+        except Exception as e:
+            future.set_exception(e)
+    
+    def _complete(self, prompt: str, max_tokens: int) -> str:
+        """Run a single prompt as its own chat completion."""
+        response = self.client.chat.completions.create(
+            model=self.model,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=self.temperature,
+            max_tokens=max_tokens
+        )
+        return response.choices[0].message.content.strip()
+    
+    def _complete_batch(self, prompts: List[str], token_limits: List[int]) -> List[str]:
+        """Answer several prompts with one chat completion."""
+        numbered = "\n\n".join(f"Problem {i}:\n{prompt.strip()}" for i, prompt in enumerate(prompts, 1))
+        batch_prompt = (
+            f"Answer each of the following {len(prompts)} problems independently.\n\n"
+            f"{numbered}\n\n"
+            'Return a JSON object of the form {"answers": ["answer to problem 1", ...]} '
+            "with exactly one answer per problem, in order."
+        )
+        
+        response = self.client.chat.completions.create(
+            model=self.model,
+            messages=[{"role": "user", "content": batch_prompt}],
+            temperature=self.temperature,
+            max_tokens=sum(token_limits),
+            response_format={"type": "json_object"}
+        )
+        answers = json.loads(response.choices[0].message.content)["answers"]
+        if len(answers) != len(prompts):
+            raise ValueError(f"expected {len(prompts)} answers, got {len(answers)}")
+        
+        self.logger.log_info("Batched LLM completion", metadata={"batch_size": len(prompts)})
+        return [str(answer).strip() for answer in answers]
@@ -0,0 +1,56 @@
+"""Embedding utilities for the modular chatbot."""
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import List
+from langchain_openai import OpenAIEmbeddings
+from config import Config
+from utils.http_client import shared_http_client
+
+# Query embeddings shared by every CachedOpenAIEmbeddings instance
+_query_cache: "OrderedDict[str, List[float]]" = OrderedDict()
+_query_cache_lock = threading.Lock()
+
+def _query_cache_key(model: str, text: str) -> str:
+    """Build the cache key from the model and the normalized query text."""
+    normalized = " ".join(text.lower().split())
+    return hashlib.sha256(f"{model}\n{normalized}".encode("utf-8")).hexdigest()
+
+class CachedOpenAIEmbeddings(OpenAIEmbeddings):
+    """OpenAI embeddings with an LRU cache on the query embedding path."""
+    
+    def embed_query(self, text: str) -> List[float]:
+        """Embed a query, reusing the vector of a previously seen equivalent query."""
+        key = _query_cache_key(self.model, text)
+        
+        with _query_cache_lock:
+            vector = _query_cache.get(key)
+            if vector is not None:
+                _query_cache.move_to_end(key)
+                return vector
+        
+        vector = super().embed_query(text)
+        
+        with _query_cache_lock:
+            _query_cache[key] = vector
+            while len(_query_cache) > Config.QUERY_EMBEDDING_CACHE_SIZE:
+                _query_cache.popitem(last=False)
+        
+        return vector
+
+def create_embeddings() -> CachedOpenAIEmbeddings:
+    """Create the OpenAI embeddings client used for indexing and query lookups."""
+    return CachedOpenAIEmbeddings(
+        api_key=Config.OPENAI_API_KEY,
+        model=Config.EMBEDDING_MODEL,
+        chunk_size=Config.EMBEDDING_BATCH_SIZE,
+        max_retries=3,
+        request_timeout=30,
+        http_client=shared_http_client
+    )
+
+@lru_cache(maxsize=1)
+def get_embeddings() -> CachedOpenAIEmbeddings:
+    """Embeddings client shared by every agent and cache in the process."""
+    return create_embeddings()
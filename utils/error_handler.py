@@ -1,4 +1,6 @@
 """Secure error handling utilities."""
+import time
+import itertools
 import traceback
 import logging
 from typing import Optional, Dict, Any
@@ -7,14 +9,29 @@ from fastapi.responses import JSONResponse
 from pydantic import ValidationError
 from models import AgentType
 from utils.logger import StructuredLogger
-from utils.security import SecurityValidator
+from utils.security import get_security_validator, get_client_ip
+
+# Per-process sequence that keeps error IDs unique within the same millisecond
+_error_sequence = itertools.count()
+
+class _LazyTraceback:
+    """Traceback captured as frame summaries, formatted only when the log entry is serialized."""
+    
+    __slots__ = ("exception",)
+    
+    def __init__(self, exception: BaseException):
+        # Source lines are read at format time, on the logging thread
+        self.exception = traceback.TracebackException.from_exception(exception, lookup_lines=False)
+    
+    def __str__(self) -> str:
+        return "".join(self.exception.format())
 
 class SecureErrorHandler:
     """Secure error handler that never exposes raw exceptions to clients."""
     
     def __init__(self):
         self.logger = StructuredLogger("SecureErrorHandler")
-        self.security_validator = SecurityValidator()
+        self.security_validator = get_security_validator()
         
         # Error type mappings for better error messages
         self.error_type_mappings = {
@@ -38,7 +55,11 @@ class SecureErrorHandler:
     
     def log_error_safely(self, exception: Exception, context: Optional[Dict[str, Any]] = None):
         """Log error with full details for debugging without exposing to client."""
-        error_id = f"ERR_{int(time.time() * 1000)}"
+        error_id = f"ERR_{time.time_ns() // 1_000_000}_{next(_error_sequence)}"
+        
+        # Capture the traceback of this exception (not whatever sys.exc_info holds) as a summary:
+        # the log holds no frames, and the exception keeps its own traceback for whoever re-raises it
+        lazy_traceback = _LazyTraceback(exception)
         
         # Extract context information
         conversation_id = context.get("conversation_id") if context else None
@@ -55,7 +76,7 @@ class SecureErrorHandler:
                 "error_id": error_id,
                 "error_type": type(exception).__name__,
                 "error_message": str(exception),
-                "traceback": traceback.format_exc(),
+                "traceback": lazy_traceback,
                 "context": context or {}
             }
         )
@@ -134,26 +155,8 @@ class SecureErrorHandler:
         return self.create_error_response(exc, {
             "path": request.url.path,
             "method": request.method,
-            "client_ip": self._get_client_ip(request)
+            "client_ip": get_client_ip(request)
         })
-    
-    def _get_client_ip(self, request: Request) -> str:
-        """Get client IP address safely."""
-        try:
-            forwarded_for = request.headers.get("X-Forwarded-For")
-            if forwarded_for:
-                return forwarded_for.split(",")[0].strip()
-            
-            real_ip = request.headers.get("X-Real-IP")
-            if real_ip:
-                return real_ip
-            
-            return request.client.host if request.client else "unknown"
-        except Exception:
-            return "unknown"
 
 # Global error handler instance
 error_handler = SecureErrorHandler()
-
-# Import time for error IDs
-import time
@@ -0,0 +1,17 @@
+"""Shared HTTP clients for OpenAI API calls."""
+import httpx
+
+# HTTP/2 needs the optional h2 package; fall back to HTTP/1.1 keep-alive without it
+try:
+    import h2  # noqa: F401
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+
+_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60)
+
+# One connection pool for every OpenAI client, chat model and embeddings client in the process
+shared_http_client = httpx.Client(http2=_HTTP2, limits=_LIMITS)
+
+# Pool for AsyncOpenAI clients awaited on the server's event loop
+shared_async_http_client = httpx.AsyncClient(http2=_HTTP2, limits=_LIMITS)
@@ -0,0 +1,15 @@
+"""Shared LangChain chat models."""
+from functools import lru_cache
+from langchain_openai import ChatOpenAI
+from config import Config
+from utils.http_client import shared_http_client
+
+@lru_cache(maxsize=None)
+def get_chat_llm(model: str, temperature: float = 0.1) -> ChatOpenAI:
+    """Chat model for the given model name and temperature, created once per process."""
+    return ChatOpenAI(
+        api_key=Config.OPENAI_API_KEY,
+        model_name=model,
+        temperature=temperature,
+        http_client=shared_http_client
+    )
@@ -1,11 +1,102 @@
 """Logging utilities for the modular chatbot."""
+import io
+import sys
 import json
+import atexit
 import logging
+import queue
 import time
-from datetime import datetime
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
 from typing import Dict, Any, Optional
 from models import AgentLog, AgentType, LogLevel
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+_ORJSON_OPTIONS = (orjson.OPT_NON_STR_KEYS | orjson.OPT_UTC_Z) if orjson else 0
+
+# Display names per agent type (None is system-level), built once instead of per log call
+_AGENT_NAMES: Dict[Optional[AgentType], str] = {
+    None: "System",
+    **{agent_type: f"{agent_type.value.title()}Agent" for agent_type in AgentType}
+}
+
+# Shared by entries logged without metadata; only ever serialized, never mutated
+_NO_METADATA: Dict[str, Any] = {}
+
+def _dumps(entry: Dict[str, Any]) -> str:
+    """Serialize a log entry to JSON, in C when orjson is available."""
+    if orjson is not None:
+        return orjson.dumps(entry, default=str, option=_ORJSON_OPTIONS).decode()
+    return json.dumps(entry, default=str)
+
+def _truncate(text: str, limit: int = 200) -> str:
+    """Cut text to limit characters plus an ellipsis; short text is returned as is."""
+    return text if len(text) <= limit else f"{text[:limit]}..."
+
+@lru_cache(maxsize=1)
+def _utc_second(second: int) -> str:
+    """ISO 8601 UTC prefix for a whole second; consecutive records mostly share one."""
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(second))
+
+class _JSONMessage:
+    """Log entry that is serialized to JSON only when a handler formats it."""
+    
+    __slots__ = ("entry", "created_ns")
+    
+    def __init__(self, entry: Dict[str, Any]):
+        self.entry = entry
+        # The timestamp string is built with the rest of the JSON, off the request thread
+        self.created_ns = time.time_ns()
+    
+    def __str__(self) -> str:
+        second, nanos = divmod(self.created_ns, 1_000_000_000)
+        timestamp = f"{_utc_second(second)}.{nanos // 1000:06d}Z"
+        return _dumps({"timestamp": timestamp, **self.entry})
+
+class _DeferredQueueHandler(QueueHandler):
+    """Queue handler that hands records over unformatted."""
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Formatting (and so JSON serialization) happens on the listener thread
+        return record
+
+class _BufferedStreamHandler(logging.StreamHandler):
+    """Stream handler that flushes once per burst of queued records instead of per record."""
+    
+    def emit(self, record: logging.LogRecord):
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+            # Errors are written out right away so a crash does not lose them
+            if record.levelno >= logging.ERROR or _log_queue.empty():
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+def _buffered_stderr() -> io.TextIOBase:
+    """stderr behind a 64 KiB buffer, or plain sys.stderr when it has no file descriptor."""
+    try:
+        raw = open(sys.stderr.fileno(), "wb", buffering=65536, closefd=False)
+    except (AttributeError, OSError, ValueError):
+        return sys.stderr
+    return io.TextIOWrapper(raw, encoding=sys.stderr.encoding or "utf-8", errors="backslashreplace")
+
+# Console output is written by a background thread so requests never block on it
+_log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+_console_handler = _BufferedStreamHandler(_buffered_stderr())
+_console_handler.setLevel(logging.INFO)
+_console_handler.setFormatter(logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+))
+_listener = QueueListener(_log_queue, _console_handler, respect_handler_level=True)
+_listener.start()
+# atexit runs in reverse: stop the listener (draining the queue), then flush what it wrote
+atexit.register(_console_handler.flush)
+atexit.register(_listener.stop)
+
 class StructuredLogger:
     """Structured logger for agent operations."""
     
@@ -13,19 +104,11 @@ class StructuredLogger:
         self.logger = logging.getLogger(name)
         self.logger.setLevel(logging.INFO)
         
-        # Create console handler
-        handler = logging.StreamHandler()
-        handler.setLevel(logging.INFO)
-        
-        # Create formatter
-        formatter = logging.Formatter(
-            '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-        )
-        handler.setFormatter(formatter)
-        
         # Add handler to logger
         if not self.logger.handlers:
-            self.logger.addHandler(handler)
+            self.logger.addHandler(_DeferredQueueHandler(_log_queue))
+        # Only the queue handler sees these records, so no root handler writes on the caller's thread
+        self.logger.propagate = False
     
     def log_agent_decision(self, agent_type: AgentType, confidence: float, 
                           reasoning: str, user_message: str, 
@@ -35,8 +118,10 @@ class StructuredLogger:
                           decision: Optional[str] = None,
                           metadata: Optional[Dict[str, Any]] = None):
         """Log router agent decision with full observability."""
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        
         log_entry = {
-            "timestamp": datetime.now().isoformat() + "Z",
             "level": "INFO",
             "agent": "RouterAgent",
             "conversation_id": conversation_id,
@@ -45,11 +130,11 @@ class StructuredLogger:
             "decision": decision or agent_type.value,
             "confidence": confidence,
             "reasoning": reasoning,
-            "processed_content": user_message[:200] + "..." if len(user_message) > 200 else user_message,
-            "metadata": metadata or {}
+            "processed_content": _truncate(user_message),
+            "metadata": metadata or _NO_METADATA
         }
         
-        self.logger.info(json.dumps(log_entry, default=str))
+        self.logger.info(_JSONMessage(log_entry))
     
     def log_agent_execution(self, agent_type: AgentType, message: str,
                            execution_time: float, 
@@ -58,18 +143,20 @@ class StructuredLogger:
                            processed_content: Optional[str] = None,
                            metadata: Optional[Dict[str, Any]] = None):
         """Log agent execution details with full observability."""
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        
         log_entry = {
-            "timestamp": datetime.now().isoformat() + "Z",
             "level": "INFO",
-            "agent": f"{agent_type.value.title()}Agent",
+            "agent": _AGENT_NAMES[agent_type],
             "conversation_id": conversation_id,
             "user_id": user_id,
             "execution_time": execution_time,
-            "processed_content": processed_content or message[:200] + "..." if len(message) > 200 else message,
-            "metadata": metadata or {}
+            "processed_content": _truncate(processed_content if processed_content is not None else message),
+            "metadata": metadata or _NO_METADATA
         }
         
-        self.logger.info(json.dumps(log_entry, default=str))
+        self.logger.info(_JSONMessage(log_entry))
     
     def log_error(self, agent_type: AgentType, error: str, 
                   conversation_id: Optional[str] = None,
@@ -77,18 +164,20 @@ class StructuredLogger:
                   execution_time: Optional[float] = None,
                   metadata: Optional[Dict[str, Any]] = None):
         """Log error messages with full observability."""
+        if not self.logger.isEnabledFor(logging.ERROR):
+            return
+        
         log_entry = {
-            "timestamp": datetime.now().isoformat() + "Z",
             "level": "ERROR",
-            "agent": f"{agent_type.value.title()}Agent" if agent_type else "System",
+            "agent": _AGENT_NAMES[agent_type],
             "conversation_id": conversation_id,
             "user_id": user_id,
             "execution_time": execution_time,
             "error": error,
-            "metadata": metadata or {}
+            "metadata": metadata or _NO_METADATA
         }
         
-        self.logger.error(json.dumps(log_entry, default=str))
+        self.logger.error(_JSONMessage(log_entry))
     
     def log_info(self, message: str, agent_type: Optional[AgentType] = None,
                  conversation_id: Optional[str] = None,
@@ -96,18 +185,20 @@ class StructuredLogger:
                  execution_time: Optional[float] = None,
                  metadata: Optional[Dict[str, Any]] = None):
         """Log general information with full observability."""
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        
         log_entry = {
-            "timestamp": datetime.now().isoformat() + "Z",
             "level": "INFO",
-            "agent": f"{agent_type.value.title()}Agent" if agent_type else "System",
+            "agent": _AGENT_NAMES[agent_type],
             "conversation_id": conversation_id,
             "user_id": user_id,
             "execution_time": execution_time,
             "message": message,
-            "metadata": metadata or {}
+            "metadata": metadata or _NO_METADATA
         }
         
-        self.logger.info(json.dumps(log_entry, default=str))
+        self.logger.info(_JSONMessage(log_entry))
     
     def log_debug(self, message: str, agent_type: Optional[AgentType] = None,
                   conversation_id: Optional[str] = None,
@@ -115,15 +206,17 @@ class StructuredLogger:
                   execution_time: Optional[float] = None,
                   metadata: Optional[Dict[str, Any]] = None):
         """Log debug information with full observability."""
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        
         log_entry = {
-            "timestamp": datetime.now().isoformat() + "Z",
             "level": "DEBUG",
-            "agent": f"{agent_type.value.title()}Agent" if agent_type else "System",
+            "agent": _AGENT_NAMES[agent_type],
             "conversation_id": conversation_id,
             "user_id": user_id,
             "execution_time": execution_time,
             "message": message,
-            "metadata": metadata or {}
+            "metadata": metadata or _NO_METADATA
         }
         
-        self.logger.debug(json.dumps(log_entry, default=str))
+        self.logger.debug(_JSONMessage(log_entry))
@@ -0,0 +1,41 @@
+"""Retrievers for the knowledge base vector store."""
+from typing import List, Optional
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_community.vectorstores import FAISS
+
+class ThresholdMMRRetriever(BaseRetriever):
+    """MMR retriever that drops documents below a cosine-similarity floor.
+    
+    Documents more than ``distance_gap_ratio`` times as far from the query as the
+    best hit are dropped too, so a clearly sufficient top chunk is sent alone.
+    Scores come from the MMR search itself, so no extra embedding calls are made.
+    """
+    
+    vectorstore: FAISS
+    k: int = 2
+    fetch_k: int = 10
+    lambda_mult: float = 0.5
+    similarity_threshold: float = 0.75
+    distance_gap_ratio: Optional[float] = 2.0
+    
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        """Return up to k diverse documents that are similar enough to the query."""
+        embedding = self.vectorstore.embeddings.embed_query(query)
+        docs_and_distances = self.vectorstore.max_marginal_relevance_search_with_score_by_vector(
+            embedding,
+            k=self.k,
+            fetch_k=self.fetch_k,
+            lambda_mult=self.lambda_mult
+        )
+        # The index returns squared L2 distances between unit vectors: cos = 1 - d / 2
+        docs_and_distances = [
+            (doc, distance) for doc, distance in docs_and_distances
+            if 1 - distance / 2 >= self.similarity_threshold
+        ]
+        if not docs_and_distances or self.distance_gap_ratio is None:
+            return [doc for doc, _ in docs_and_distances]
+        
+        max_distance = min(distance for _, distance in docs_and_distances) * self.distance_gap_ratio
+        return [doc for doc, distance in docs_and_distances if distance <= max_distance]
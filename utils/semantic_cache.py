@@ -0,0 +1,168 @@
+"""Semantic cache for reusing answers to near-duplicate queries."""
+import json
+import time
+import base64
+import threading
+from functools import lru_cache
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+import faiss
+import numpy as np
+import redis
+from langchain_openai import OpenAIEmbeddings
+from config import Config
+from utils.logger import StructuredLogger
+
+logger = StructuredLogger("SemanticCache")
+
+@lru_cache(maxsize=1)
+def get_cache_redis() -> Optional[redis.Redis]:
+    """Redis client shared by the semantic caches, or None when Redis is unavailable."""
+    if not Config.SEMANTIC_CACHE_REDIS:
+        return None
+    
+    try:
+        client = redis.Redis(
+            host=Config.REDIS_HOST,
+            port=Config.REDIS_PORT,
+            db=Config.REDIS_DB,
+            password=Config.REDIS_PASSWORD,
+            decode_responses=True,
+            socket_connect_timeout=1,
+            socket_timeout=1
+        )
+        client.ping()
+        return client
+    except redis.RedisError as e:
+        logger.log_error(None, f"Semantic cache Redis unavailable, caching in process only: {str(e)}")
+        return None
+
+class SemanticCache:
+    """Cache that returns a stored value when a new query is semantically close to a cached one.
+    
+    Lookups run against an in-process FAISS index. When a Redis client is given, entries
+    are also published to Redis (with a TTL) under ``namespace`` so every worker picks up
+    answers computed by the others.
+    """
+    
+    def __init__(self, embeddings: OpenAIEmbeddings,
+                 threshold: Optional[float] = None,
+                 max_entries: Optional[int] = None,
+                 ttl_seconds: Optional[int] = None,
+                 redis_client: Optional[redis.Redis] = None,
+                 namespace: str = "default",
+                 encode: Callable[[Any], str] = json.dumps,
+                 decode: Callable[[str], Any] = json.loads):
+        self.embeddings = embeddings
+        self.threshold = threshold if threshold is not None else Config.SEMANTIC_CACHE_THRESHOLD
+        self.max_entries = max_entries or Config.SEMANTIC_CACHE_SIZE
+        self.ttl_seconds = ttl_seconds or Config.SEMANTIC_CACHE_TTL
+        
+        # Inner-product index over L2-normalized vectors, i.e. cosine similarity.
+        # Created lazily because the embedding dimension is only known on first insert.
+        self.index: Optional[faiss.IndexIDMap2] = None
+        self.entries: Dict[int, Tuple[Any, float]] = {}
+        self.next_slot = 0
+        self.lock = threading.Lock()
+        
+        # Shared entries live at "semantic_cache:<namespace>:<id>"; ids come from a counter
+        self.redis = redis_client
+        self.key_prefix = f"semantic_cache:{namespace}"
+        self.encode = encode
+        self.decode = decode
+        self.last_synced_id = 0
+        self.published_ids: Set[int] = set()
+    
+    def embed(self, text: str) -> np.ndarray:
+        """Embed a query as a normalized (1, dim) vector usable by get/put."""
+        vector = np.asarray([self.embeddings.embed_query(text)], dtype=np.float32)
+        faiss.normalize_L2(vector)
+        return vector
+    
+    def get(self, vector: np.ndarray) -> Optional[Any]:
+        """Return the cached value of the closest query above the similarity threshold."""
+        with self.lock:
+            self._sync()
+            
+            if self.index is None or self.index.ntotal == 0:
+                return None
+            
+            scores, ids = self.index.search(vector, 1)
+            slot = int(ids[0][0])
+            if slot < 0 or scores[0][0] < self.threshold:
+                return None
+            
+            value, created_at = self.entries[slot]
+            if time.time() - created_at > self.ttl_seconds:
+                self._evict(slot)
+                return None
+            
+            return value
+    
+    def put(self, vector: np.ndarray, value: Any):
+        """Store a value locally and publish it to the other workers."""
+        with self.lock:
+            created_at = time.time()
+            self._insert(vector, value, created_at)
+            self._publish(vector, value, created_at)
+    
+    def _insert(self, vector: np.ndarray, value: Any, created_at: float):
+        """Add an entry to the local index, overwriting the oldest once the ring buffer is full."""
+        if self.index is None:
+            self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(vector.shape[1]))
+        
+        slot = self.next_slot
+        self.next_slot = (slot + 1) % self.max_entries
+        if slot in self.entries:
+            self._evict(slot)
+        
+        self.index.add_with_ids(vector, np.array([slot], dtype=np.int64))
+        self.entries[slot] = (value, created_at)
+    
+    def _evict(self, slot: int):
+        """Remove a slot from the index and the entry table."""
+        self.index.remove_ids(np.array([slot], dtype=np.int64))
+        del self.entries[slot]
+    
+    def _publish(self, vector: np.ndarray, value: Any, created_at: float):
+        """Write an entry to Redis with the cache TTL."""
+        if self.redis is None:
+            return
+        
+        try:
+            entry_id = self.redis.incr(f"{self.key_prefix}:seq")
+            self.redis.setex(f"{self.key_prefix}:{entry_id}", self.ttl_seconds, json.dumps({
+                "vector": base64.b64encode(vector.tobytes()).decode("ascii"),
+                "value": self.encode(value),
+                "created_at": created_at
+            }))
+            # Already in the local index; skip it on the next sync
+            self.published_ids.add(entry_id)
+        except redis.RedisError as e:
+            logger.log_error(None, f"Semantic cache publish failed: {str(e)}")
+    
+    def _sync(self):
+        """Pull entries other workers published since the last sync into the local index."""
+        if self.redis is None:
+            return
+        
+        try:
+            latest_id = int(self.redis.get(f"{self.key_prefix}:seq") or 0)
+            if latest_id <= self.last_synced_id:
+                return
+            
+            first_id = max(self.last_synced_id + 1, latest_id - self.max_entries + 1)
+            entry_ids = [i for i in range(first_id, latest_id + 1) if i not in self.published_ids]
+            payloads = self.redis.mget([f"{self.key_prefix}:{i}" for i in entry_ids]) if entry_ids else []
+            
+            for payload in payloads:
+                # Expired entries come back as None
+                if not payload:
+                    continue
+                entry = json.loads(payload)
+                vector = np.frombuffer(base64.b64decode(entry["vector"]), dtype=np.float32).reshape(1, -1)
+                self._insert(vector, self.decode(entry["value"]), entry["created_at"])
+            
+            self.published_ids = {i for i in self.published_ids if i > latest_id}
+            self.last_synced_id = latest_id
+        except (redis.RedisError, ValueError, KeyError) as e:
+            logger.log_error(None, f"Semantic cache sync failed: {str(e)}")